@@ -0,0 +1,456 @@
+"""Offline benchmark of lambda_handler.
+
+Replaces boto3.client with local fakes of STS, Cost Explorer, Budgets, S3 and SES
+that answer from a synthetic organization, so no request leaves the machine.
+Each organization size runs in its own process and reports the wall time, the
+API calls by operation, the peak RSS and the size of the report files.
+
+    python benchmark.py --accounts 10 100 1000
+
+The cache is off and the API rate limits are lifted, so the runs measure the
+Lambda itself. --defaults runs it as a default deployment instead, with the
+cache in a new file and the default rate limits.
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from collections import Counter
+from datetime import date, datetime, timedelta, timezone
+
+from botocore.exceptions import ClientError
+
+PAYER = '123456789111'
+
+SERVICES = [
+    'Amazon Elastic Compute Cloud - Compute', 'Amazon Relational Database Service', 'Amazon Simple Storage Service',
+    'AWS Lambda', 'Amazon CloudWatch', 'Amazon Redshift', 'Amazon ElastiCache', 'Amazon OpenSearch Service',
+    'Amazon DynamoDB', 'AWS Key Management Service', 'Amazon Route 53', 'Amazon Virtual Private Cloud',
+    'Amazon Simple Queue Service', 'Amazon Simple Notification Service', 'AWS CloudTrail', 'Tax'
+]
+
+# instance details key and fields of the RI recommendations of each service
+RI_INSTANCE_DETAILS = {
+    'Amazon Elastic Compute Cloud - Compute': ('EC2InstanceDetails', {'InstanceType': None, 'Platform': 'Linux/UNIX'}),
+    'Amazon Relational Database Service': ('RDSInstanceDetails', {'InstanceType': None, 'DatabaseEngine': 'MySQL', 'LicenseModel': 'No license required'}),
+    'Amazon Redshift': ('RedshiftInstanceDetails', {'NodeType': None, 'SizeFlexEligible': True}),
+    'Amazon ElastiCache': ('ElastiCacheInstanceDetails', {'NodeType': None, 'ProductDescription': 'redis'}),
+    'Amazon Elasticsearch Service': ('ESInstanceDetails', {'InstanceSize': None}),
+    'Amazon OpenSearch Service': ('ESInstanceDetails', {'InstanceSize': None})
+}
+
+INSTANCE_TYPES = ['m5.large', 'm5.xlarge', 'm5.2xlarge', 'r5.large', 'r5.xlarge', 'c5.large', 't3.medium']
+
+REGIONS = ['us-east-1', 'us-west-2', 'eu-west-1', 'ap-southeast-2']
+
+# items per page of the paginated fakes, --page-size lowers it so that every list spans pages
+PAGE_SIZE = 100
+
+calls = Counter()
+
+outputs = {}
+
+_lock = threading.Lock()
+
+
+def fraction(*parts):
+    # the same organization on every run and in every thread
+    return zlib.crc32('|'.join(str(part) for part in parts).encode()) / 0xffffffff
+
+
+def seeded(*parts):
+    return random.Random(fraction(*parts))
+
+
+def synthetic_accounts(count, owners, seed):
+
+    accounts = {}
+    for index in range(count):
+        account = PAYER if index == 0 else '2{:011d}'.format(index)
+        accounts[account] = [{
+            'acc_name': 'benchmark-account-{:04d}'.format(index),
+            'ano_arn': 'arn:aws:ce::{0}:anomalymonitor/{1}'.format(account, seeded(seed, account).randrange(16 ** 8)),
+            'acc_owner': 'owner{0}@example.com'.format(index % owners)
+        }]
+    return accounts
+
+
+def paginate_list(items, token, key, extra=None):
+
+    start = int(token or 0)
+    response = dict(extra or {})
+    response[key] = items[start:start + PAGE_SIZE]
+    if start + PAGE_SIZE < len(items):
+        response['NextPageToken'] = str(start + PAGE_SIZE)
+    return response
+
+
+class FakeClient:
+
+    def __init__(self, service, account, org):
+        self.service = service
+        self.account = account
+        self.org = org
+
+    def __getattr__(self, name):
+        method = getattr(self, '_' + name, None)
+        if method is None:
+            raise AttributeError('benchmark has no fake for {0}.{1}'.format(self.service, name))
+
+        def call(*args, **kwargs):
+            with _lock:
+                calls['{0}.{1}'.format(self.service, name)] += 1
+            return method(*args, **kwargs)
+        return call
+
+    # sts
+    def _assume_role(self, RoleArn, RoleSessionName, **kwargs):
+        return {'Credentials': {
+            'AccessKeyId': 'AK' + RoleArn.split(':')[4],
+            'SecretAccessKey': 'secret',
+            'SessionToken': 'token',
+            'Expiration': datetime.now(timezone.utc) + timedelta(hours=1)
+        }}
+
+    def _get_caller_identity(self):
+        return {'Account': self.account, 'Arn': 'arn:aws:iam::{0}:role/benchmark'.format(self.account)}
+
+    # cost explorer
+    def daily_cost(self, account, service, day):
+        if fraction(self.org['seed'], account, service) > self.org['service_share']:
+            return 0.0
+        return 400 * fraction(account, service) * (0.7 + 0.6 * fraction(account, service, day))
+
+    def _get_cost_and_usage(self, TimePeriod, Granularity, Metrics, GroupBy=None, Filter=None, NextPageToken=None, **kwargs):
+
+        keys = [group['Key'] for group in GroupBy or []]
+        # every page of a query is cut from the same rows
+        query = (json.dumps(TimePeriod, sort_keys=True), Granularity, json.dumps(Filter, sort_keys=True), tuple(keys), self.account)
+        with _lock:
+            cached = self.org['queries'].get(query)
+        if cached is None:
+            cached = self.cost_rows(TimePeriod, Granularity, Filter, keys)
+            with _lock:
+                self.org['queries'][query] = cached
+        rows, groups = cached
+        start = int(NextPageToken or 0)
+        page = groups[start:start + PAGE_SIZE] if keys else []
+        results = []
+        for period, totals in rows:
+            result = {
+                'TimePeriod': {'Start': str(period[0]), 'End': str(period[1])},
+                'Total': {},
+                'Groups': [],
+                'Estimated': False
+            }
+            if not keys:
+                result['Total'] = {'AmortizedCost': {'Amount': '{:.10f}'.format(totals.get((), 0)), 'Unit': 'USD'}}
+            for group_period, key, amount in page:
+                if group_period == period:
+                    result['Groups'].append({'Keys': list(key), 'Metrics': {'AmortizedCost': {'Amount': '{:.10f}'.format(amount), 'Unit': 'USD'}}})
+            results.append(result)
+        response = {'ResultsByTime': results, 'DimensionValueAttributes': []}
+        if keys and start + PAGE_SIZE < len(groups):
+            response['NextPageToken'] = str(start + PAGE_SIZE)
+        return response
+
+    def cost_rows(self, TimePeriod, Granularity, Filter, keys):
+
+        if Filter and Filter.get('Dimensions', {}).get('Key') == 'LINKED_ACCOUNT':
+            accounts = Filter['Dimensions']['Values']
+        elif 'LINKED_ACCOUNT' in keys:
+            accounts = list(self.org['accounts'])
+        else:
+            accounts = [self.account]
+        start = date.fromisoformat(TimePeriod['Start'])
+        end = date.fromisoformat(TimePeriod['End'])
+        periods = []
+        while start < end:
+            if Granularity == 'DAILY':
+                period_end = start + timedelta(days=1)
+            else:
+                period_end = min(end, (start.replace(day=1) + timedelta(days=32)).replace(day=1))
+            periods.append((start, period_end))
+            start = period_end
+        # groups of all periods are paged together, like Cost Explorer does
+        rows = []
+        for period_start, period_end in periods:
+            days = [period_start + timedelta(days=n) for n in range((period_end - period_start).days)]
+            totals = {}
+            for account in accounts:
+                for service in SERVICES:
+                    amount = sum(self.daily_cost(account, service, day) for day in days)
+                    if not amount:
+                        continue
+                    group_key = tuple({'LINKED_ACCOUNT': account, 'SERVICE': service}[key] for key in keys)
+                    totals[group_key] = totals.get(group_key, 0) + amount
+            rows.append(((period_start, period_end), totals))
+        groups = [(period, key, amount) for period, totals in rows for key, amount in totals.items() if key]
+        return rows, groups
+
+    def _get_anomalies(self, DateInterval, MonitorArn=None, TotalImpact=None, NextPageToken=None, **kwargs):
+
+        if MonitorArn is None:
+            # the payer account sees the anomalies of every monitor
+            anomalies = []
+            for monitor_arn in dict.fromkeys(entry[0]['ano_arn'] for entry in self.org['accounts'].values()):
+                anomalies.extend(self.monitor_anomalies(DateInterval, monitor_arn, TotalImpact))
+            return paginate_list(anomalies, NextPageToken, 'Anomalies')
+        return paginate_list(self.monitor_anomalies(DateInterval, MonitorArn, TotalImpact), NextPageToken, 'Anomalies')
+
+    def monitor_anomalies(self, DateInterval, MonitorArn, TotalImpact):
+
+        rng = seeded(self.org['seed'], MonitorArn)
+        monitor_account = MonitorArn.split(':')[4]
+        anomalies = []
+        for index in range(rng.randint(0, self.org['anomalies'])):
+            root_causes = []
+            for cause in range(rng.randint(0, 2)):
+                root_causes.append({
+                    'Service': rng.choice(SERVICES),
+                    'Region': rng.choice(REGIONS),
+                    'LinkedAccount': monitor_account,
+                    'UsageType': 'BoxUsage:' + rng.choice(INSTANCE_TYPES)
+                })
+            total_impact = round(rng.uniform(1, 2000), 2)
+            anomalies.append({
+                'AnomalyId': '{0}-{1}'.format(MonitorArn[-8:], index),
+                'AnomalyStartDate': DateInterval['StartDate'] + 'T00:00:00Z',
+                'AnomalyEndDate': DateInterval.get('EndDate', DateInterval['StartDate']) + 'T00:00:00Z',
+                'DimensionValue': rng.choice(SERVICES),
+                'RootCauses': root_causes,
+                'AnomalyScore': {'MaxScore': rng.random(), 'CurrentScore': rng.random()},
+                'Impact': {'MaxImpact': round(rng.uniform(1, 500), 2), 'TotalImpact': total_impact},
+                'MonitorArn': MonitorArn,
+                'Feedback': 'YES'
+            })
+        if TotalImpact:
+            anomalies = [anomaly for anomaly in anomalies if anomaly['Impact']['TotalImpact'] >= TotalImpact['StartValue']]
+        return anomalies
+
+    def _get_reservation_purchase_recommendation(self, Service, AccountId=None, NextPageToken=None, **kwargs):
+
+        rng = seeded(self.org['seed'], AccountId or self.account, Service, kwargs.get('TermInYears'), kwargs.get('PaymentOption'), kwargs.get('LookbackPeriodInDays'))
+        details_key, fields = RI_INSTANCE_DETAILS[Service]
+        details = []
+        for index in range(rng.randint(0, self.org['recommendations'])):
+            instance = {'Region': rng.choice(REGIONS), 'CurrentGeneration': rng.random() > 0.2}
+            for name, value in fields.items():
+                instance[name] = value if value is not None else rng.choice(INSTANCE_TYPES)
+            details.append({
+                'AccountId': AccountId or self.account,
+                'InstanceDetails': {details_key: instance},
+                'RecommendedNumberOfInstancesToPurchase': str(rng.randint(1, 8)),
+                'UpfrontCost': '{:.4f}'.format(rng.uniform(100, 20000)),
+                'EstimatedMonthlySavingsAmount': '{:.4f}'.format(rng.uniform(1, 500)),
+                'EstimatedMonthlyOnDemandCost': '{:.4f}'.format(rng.uniform(100, 2000)),
+                'CurrencyCode': 'USD'
+            })
+        # the details are split over the pages, each page wraps its part in a recommendation
+        page = paginate_list(details, NextPageToken, 'RecommendationDetails', {'Metadata': {'RecommendationId': 'benchmark'}})
+        page['Recommendations'] = [{'RecommendationDetails': page.pop('RecommendationDetails')}] if details else []
+        return page
+
+    def _get_savings_plans_purchase_recommendation(self, SavingsPlansType, NextPageToken=None, **kwargs):
+
+        rng = seeded(self.org['seed'], self.account, SavingsPlansType, kwargs.get('TermInYears'), kwargs.get('PaymentOption'))
+        details = []
+        for index in range(rng.randint(0, self.org['recommendations'])):
+            plan = {'OfferingId': '{0:08x}'.format(rng.randrange(16 ** 8))}
+            if SavingsPlansType == 'EC2_INSTANCE_SP':
+                plan['Region'] = rng.choice(REGIONS)
+                plan['InstanceFamily'] = rng.choice(INSTANCE_TYPES).split('.')[0]
+            details.append({
+                'AccountId': self.account,
+                'SavingsPlansDetails': plan,
+                'HourlyCommitmentToPurchase': '{:.3f}'.format(rng.uniform(0.1, 20)),
+                'UpfrontCost': '{:.4f}'.format(rng.uniform(100, 20000)),
+                'EstimatedMonthlySavingsAmount': '{:.4f}'.format(rng.uniform(1, 2000)),
+                'EstimatedSavingsPercentage': '{:.2f}'.format(rng.uniform(5, 40)),
+                'CurrencyCode': 'USD'
+            })
+        # the details of every page are wrapped in the recommendation, the token is outside it
+        page = paginate_list(details, NextPageToken, 'SavingsPlansPurchaseRecommendationDetails')
+        response = {'Metadata': {'RecommendationId': 'benchmark'}, 'SavingsPlansPurchaseRecommendation': {
+            'AccountScope': kwargs.get('AccountScope', 'PAYER'),
+            'SavingsPlansType': SavingsPlansType,
+            'SavingsPlansPurchaseRecommendationDetails': page['SavingsPlansPurchaseRecommendationDetails']
+        }}
+        if 'NextPageToken' in page:
+            response['NextPageToken'] = page['NextPageToken']
+        return response
+
+    # budgets
+    def _describe_budgets(self, AccountId, MaxResults=100, NextToken=None, **kwargs):
+        budgets = []
+        rng = seeded(self.org['seed'], AccountId, 'budget')
+        if rng.random() <= self.org['budget_share']:
+            budgets.append({
+                'BudgetName': 'finops-ACCOUNT_{0}_MONTHLY_{1}'.format(AccountId, date.today().year),
+                'BudgetLimit': {'Amount': '{:.1f}'.format(rng.uniform(500, 50000)), 'Unit': 'USD'},
+                'TimeUnit': 'MONTHLY',
+                'BudgetType': 'COST'
+            })
+        rng = seeded(self.org['seed'], AccountId, 'budgets')
+        if rng.random() <= 0.5:
+            budgets.append({
+                'BudgetName': 'monthly',
+                'BudgetLimit': {'Amount': '{:.1f}'.format(rng.uniform(500, 50000)), 'Unit': 'USD'},
+                'TimeUnit': 'MONTHLY',
+                'BudgetType': 'COST'
+            })
+        start = int(NextToken or 0)
+        response = {'Budgets': budgets[start:start + MaxResults]}
+        if start + MaxResults < len(budgets):
+            response['NextToken'] = str(start + MaxResults)
+        return response
+
+    def _get_send_quota(self):
+        return {'Max24HourSend': 50000.0, 'MaxSendRate': 14.0, 'SentLast24Hours': 0.0}
+
+    # s3
+    def _upload_file(self, Filename, Bucket, Key, **kwargs):
+        with _lock:
+            outputs['s3://{0}/{1}'.format(Bucket, Key)] = os.path.getsize(Filename)
+
+    def _upload_fileobj(self, Fileobj, Bucket, Key, **kwargs):
+        size = len(Fileobj.read())
+        with _lock:
+            outputs['s3://{0}/{1}'.format(Bucket, Key)] = size
+
+    def _generate_presigned_url(self, ClientMethod, Params, ExpiresIn=3600):
+        return 'https://{0}.s3.amazonaws.com/{1}?X-Amz-Expires={2}'.format(Params['Bucket'], Params['Key'], ExpiresIn)
+
+    def _download_file(self, Bucket, Key, Filename, **kwargs):
+        raise ClientError({'Error': {'Code': '404', 'Message': 'Not Found'}}, 'HeadObject')
+
+    # ses
+    def _send_raw_email(self, Source, Destinations, RawMessage, **kwargs):
+        with _lock:
+            outputs['email'] = outputs.get('email', 0) + len(RawMessage['Data'])
+        return {'MessageId': 'benchmark-{0}'.format(calls['ses.send_raw_email'])}
+
+
+def install(org):
+
+    import boto3
+
+    def client(service_name, aws_access_key_id=None, region_name=None, **kwargs):
+        # assumed role keys carry the account they were issued for
+        account = aws_access_key_id[2:] if aws_access_key_id else PAYER
+        return FakeClient(service_name, account, org)
+    boto3.client = client
+
+
+def peak_rss_mib():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def run(args):
+
+    global PAGE_SIZE
+    PAGE_SIZE = args.page_size
+    org = {
+        'seed': args.seed,
+        'anomalies': args.anomalies,
+        'recommendations': args.recommendations,
+        'service_share': args.service_share,
+        'budget_share': args.budget_share
+    }
+    accounts = synthetic_accounts(args.run, args.owners, args.seed)
+    org['accounts'] = accounts
+    org['queries'] = {}
+    install(org)
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import lambda_code_github
+    lambda_code_github.aws_accounts = accounts
+    lambda_code_github.recipients = ['benchmark@example.com']
+
+    started = time.perf_counter()
+    lambda_code_github.lambda_handler({}, None)
+    wall = time.perf_counter() - started
+
+    # workbook sizes as measured by the handler, the workbooks never touch the disk
+    run_metrics = lambda_code_github.metrics
+    for name, value in run_metrics.run.items():
+        if run_metrics.units[name] == 'Bytes':
+            outputs[name] = value
+    return {
+        'accounts': args.run,
+        'wall_seconds': round(wall, 3),
+        'peak_rss_mib': round(peak_rss_mib(), 1),
+        'api_calls': dict(sorted(calls.items())),
+        'outputs': outputs
+    }
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--accounts', type=int, nargs='+', default=[10, 100, 1000], help='organization sizes to run')
+    parser.add_argument('--owners', type=int, default=10, help='account owners, one worksheet each')
+    parser.add_argument('--anomalies', type=int, default=12, help='most anomalies per monitor')
+    parser.add_argument('--recommendations', type=int, default=6, help='most RI recommendations per account and service')
+    parser.add_argument('--service-share', type=float, default=0.6, help='share of services with costs in an account')
+    parser.add_argument('--budget-share', type=float, default=0.8, help='share of accounts with a finops budget')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--page-size', type=int, default=PAGE_SIZE, help='items per page of the fake responses, 2 makes most responses span pages')
+    parser.add_argument('--rate-limits', action='store_true', help='keep the API rate limits, by default they are lifted')
+    parser.add_argument('--defaults', action='store_true', help='run as a default deployment: cache on and rate limits kept')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--run', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        # only the results go to stdout, the handler prints to stderr
+        stdout = sys.stdout
+        sys.stdout = sys.stderr
+        result = run(args)
+        stdout.write(json.dumps(result) + '\n')
+        return
+
+    env = dict(os.environ)
+    env.setdefault('ASSUME_ROLE', 'benchmark')
+    env.setdefault('SES_REGION', 'us-east-1')
+    env.setdefault('SEND_FROM', 'benchmark@example.com')
+    # a default deployment caches the responses in a new file of every container
+    cache_dir = tempfile.TemporaryDirectory() if args.defaults and 'CACHE_PATH' not in env else None
+    if not args.defaults:
+        env.setdefault('CACHE_PATH', '')
+    if not args.rate_limits and not args.defaults:
+        for name in ('CE_RATE_LIMIT', 'BUDGETS_RATE_LIMIT', 'STS_RATE_LIMIT', 'SES_RATE_LIMIT'):
+            env.setdefault(name, '1000000')
+    results = []
+    for count in args.accounts:
+        if cache_dir is not None:
+            env['CACHE_PATH'] = os.path.join(cache_dir.name, 'ce_cache-{0}.sqlite'.format(count))
+        # a fresh process per size, so peak RSS and the module level caches start empty
+        command = [sys.executable, os.path.abspath(__file__), '--run', str(count)] + sys.argv[1:]
+        completed = subprocess.run(command, env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+        result = json.loads(completed.stdout.decode().splitlines()[-1])
+        results.append(result)
+        print('{accounts:>6} accounts  {wall_seconds:>8.3f} s  {peak_rss_mib:>8.1f} MiB peak RSS  {calls:>7} API calls'.format(
+            calls=sum(result['api_calls'].values()), **result))
+        for operation, number in result['api_calls'].items():
+            print('        {0:<55} {1:>7}'.format(operation, number))
+        for name, size in sorted(result['outputs'].items()):
+            print('        {0:<55} {1:>7.1f} KiB'.format(name, size / 1024))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1)
+    if cache_dir is not None:
+        cache_dir.cleanup()
+
+
+if __name__ == '__main__':
+    main()
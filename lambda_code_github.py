@@ -1,80 +1,2414 @@
+import time
+# module load time is reported with the metrics of the first invocation
+_import_started = time.perf_counter()
 import boto3
-from datetime import datetime, date, timedelta
+from datetime import datetime, date, timedelta, timezone
 import os
 import decimal
+from botocore.config import Config
 from botocore.exceptions import ClientError
 import logging
-from openpyxl import Workbook
-from openpyxl.utils import get_column_letter
-from openpyxl.styles import Font
-from openpyxl.cell import Cell
+from copy import copy
+import threading
+import json
+import hashlib
+import zlib
+import tempfile
+import io
+import base64
+from functools import partial
+import random
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from itertools import islice
+from dataclasses import dataclass, field, asdict
+# openpyxl, the MIME classes, sqlite3 and zipfile are imported where they are used,
+# so runs that do not render or cache do not load them on a cold start
 
-from email import encoders
-from email.mime.base import MIMEBase
-from email.mime.application import MIMEApplication
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
+ASSUME_ROLE = os.environ['ASSUME_ROLE']
+
+# account the Lambda runs in, its calls need no assumed role. Read from STS when empty
+LOCAL_ACCOUNT_ID = os.environ.get('LOCAL_ACCOUNT_ID', '')
+
+SES_REGION = os.environ['SES_REGION']
+
+SUBJECT = "[AWS COSTING]: AWS Costs from {} to {}"
+
+CHARSET = 'UTF-8'
+
+SEND_FROM = os.environ['SEND_FROM']
+
+# number of accounts collected in parallel and number of independent API calls in flight
+ACCOUNT_WORKERS = int(os.environ.get('ACCOUNT_WORKERS', '4'))
+
+API_WORKERS = int(os.environ.get('API_WORKERS', '8'))
+
+# 'account' queries costs in every account, 'organization' queries them once from the payer account
+COST_QUERY_MODE = os.environ.get('COST_QUERY_MODE', 'account')
+
+# sqlite cache of Cost Explorer responses, set CACHE_PATH to an empty value to disable it
+CACHE_PATH = os.environ.get('CACHE_PATH', '/tmp/ce_cache.sqlite')
+
+CACHE_S3_BUCKET = os.environ.get('CACHE_S3_BUCKET', '')
+
+CACHE_S3_KEY = os.environ.get('CACHE_S3_KEY', 'cache/ce_cache.sqlite')
+
+CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+
+# new responses are committed at most this often while the accounts are collected
+CACHE_COMMIT_SECONDS = 1
+
+# free space in the cache file above which it is vacuumed even when nothing was evicted for size
+CACHE_VACUUM_BYTES = 4 * 1024 * 1024
+
+# cost of a period is final once the period ended this long ago
+COST_SETTLE_TIME = timedelta(days=2)
+
+# 'full' fetches the week and month to date totals every run, 'incremental' keeps daily
+# costs in the cache database and only fetches days that are not stored yet
+COST_INGESTION_MODE = os.environ.get('COST_INGESTION_MODE', 'full')
+
+# recent days are fetched again because Cost Explorer still restates them
+RESTATEMENT_DAYS = int(os.environ.get('RESTATEMENT_DAYS', '3'))
+
+# weeks of service costs kept in the cache database for the previous week and trailing
+# average columns, 0 (default) leaves the columns out
+TREND_WEEKS = int(os.environ.get('TREND_WEEKS', '0'))
+
+# 'standard' keeps the workbooks in memory until they are saved, 'streaming' writes
+# write-only sheets as soon as all accounts of an owner are rendered
+EXCEL_MODE = os.environ.get('EXCEL_MODE', 'standard')
+
+# write-only sheets are written before the longest values are known, so their columns get
+# this many characters, or the length of the header when it is longer
+STREAMING_COLUMN_WIDTH = 24
+
+STREAMING_COLUMNS = 20
+
+# above this many bytes the HTML body is spooled to a temporary file, 0 keeps it in memory
+HTML_SPOOL_BYTES = int(os.environ.get('HTML_SPOOL_BYTES', '0'))
+
+# requests per second allowed per account and service, lowered while the service throttles
+API_RATES = {
+    'ce': float(os.environ.get('CE_RATE_LIMIT', '5')),
+    'budgets': float(os.environ.get('BUDGETS_RATE_LIMIT', '5')),
+    'sts': float(os.environ.get('STS_RATE_LIMIT', '10')),
+    'ses': float(os.environ.get('SES_RATE_LIMIT', '1'))
+}
+
+# attempts per call while it is throttled, at least one, backoff starts at RETRY_BASE_DELAY seconds
+RETRY_ATTEMPTS = max(1, int(os.environ.get('RETRY_ATTEMPTS', '6')))
+
+RETRY_BASE_DELAY = float(os.environ.get('RETRY_BASE_DELAY', '0.5'))
+
+RETRY_MAX_DELAY = 20
+
+THROTTLING_ERRORS = ('Throttling', 'ThrottlingException', 'TooManyRequestsException', 'RequestLimitExceeded', 'LimitExceededException')
+
+# namespace of the run metrics written as CloudWatch embedded metric format log lines,
+# set METRICS_NAMESPACE to an empty value to turn them off
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'AwsCostReport')
+
+# where shard invocations leave their account reports for merge_handler,
+# an s3://bucket/prefix URL or a local directory
+SHARD_PATH = os.environ.get('SHARD_PATH', 's3://aws-ce-reports/shards')
+
+# above this many bytes of attachments the email links to the reports in S3 instead,
+# SES rejects raw messages over 10 MB and base64 adds a third
+ATTACHMENT_LINK_BYTES = int(os.environ.get('ATTACHMENT_LINK_BYTES', str(7 * 1024 * 1024)))
+
+# 'none' attaches the workbooks as they are, 'zip' packs them into one zip file
+ATTACHMENT_COMPRESSION = os.environ.get('ATTACHMENT_COMPRESSION', 'none')
+
+# seconds the S3 links stay valid, they also end when the Lambda role credentials expire
+LINK_EXPIRY = int(os.environ.get('LINK_EXPIRY', str(12 * 3600)))
+
+# 'combined' sends one email with every account to recipients, 'owner' sends every
+# account owner an email and workbooks with only their accounts
+DELIVERY_MODE = os.environ.get('DELIVERY_MODE', 'combined')
+
+# number of owner emails built and sent in parallel, the SES send rate still applies
+SES_WORKERS = int(os.environ.get('SES_WORKERS', '8'))
+
+# 'true' imports openpyxl and the MIME classes at init, for provisioned concurrency where
+# init is not on the request path. Otherwise they load in the background during collection
+PRELOAD_MODULES = os.environ.get('PRELOAD_MODULES', 'false').lower() == 'true'
+
+# 'none' (default) skips the columnar export, 'auto' writes Parquet when pyarrow is
+# installed and CSV otherwise, 'parquet' and 'csv' pick the format
+EXPORT_FORMAT = os.environ.get('EXPORT_FORMAT', 'none')
+
+# key prefix of the exported datasets in the report bucket
+EXPORT_PREFIX = os.environ.get('EXPORT_PREFIX', 'exports')
+
+# 'account' (default) reads the anomaly monitor of every account with its own role. 'monitor'
+# reads each distinct monitor once and 'organization' reads every anomaly the payer account
+# sees in one paginated query, both split the anomalies per account by their root causes
+ANOMALY_QUERY_MODE = os.environ.get('ANOMALY_QUERY_MODE', 'account')
+
+# anomalies with a smaller total impact are filtered out by Cost Explorer, 0 keeps all of them
+ANOMALY_MIN_IMPACT = float(os.environ.get('ANOMALY_MIN_IMPACT', '0'))
+
+# 'mark' keeps the anomalies reported each week in the cache database and marks every anomaly
+# as new, ongoing, grown or resolved, 'changes' also leaves out the ongoing ones, 'off' (default)
+ANOMALY_TRACKING = os.environ.get('ANOMALY_TRACKING', 'off')
+
+# 'single' fetches the RI recommendations for one year, all upfront and a thirty day lookback,
+# 'matrix' fetches every term, payment option and lookback concurrently and picks the best
+RI_RECOMMENDATION_MODE = os.environ.get('RI_RECOMMENDATION_MODE', 'single')
+
+# number of services shown per account, and per owner and organization in the summary
+TOP_SERVICES = 10
+
+# 'true' adds the cost of every owner and the top services of the organization to the
+# end of the combined email, computed from the collected accounts without extra calls
+ORG_SUMMARY = os.environ.get('ORG_SUMMARY', 'false').lower() == 'true'
+
+# how long data that can still change is kept
+CACHE_TTLS = {
+    'get_cost_and_usage': timedelta(hours=6),
+    'get_anomalies': timedelta(hours=6)
+}
+
+ri_services = ['Amazon Elastic Compute Cloud - Compute', 'Amazon Relational Database Service', 'Amazon Redshift', 'Amazon ElastiCache', 'Amazon Elasticsearch Service', 'Amazon OpenSearch Service']
+
+savings_plans_types = ['COMPUTE_SP', 'EC2_INSTANCE_SP']
+
+# terms, payment options and lookbacks compared in the RI matrix mode
+RI_TERMS = ['ONE_YEAR', 'THREE_YEARS']
+
+RI_PAYMENT_OPTIONS = ['NO_UPFRONT', 'PARTIAL_UPFRONT', 'ALL_UPFRONT']
+
+RI_LOOKBACKS = ['SEVEN_DAYS', 'THIRTY_DAYS', 'SIXTY_DAYS']
+
+# every combination, in the order of the comparison sheet: a row per lookback, a column per term and payment option
+RI_MATRIX = [(term, payment, lookback) for lookback in RI_LOOKBACKS for term in RI_TERMS for payment in RI_PAYMENT_OPTIONS]
+
+RI_OPTION_LABELS = {
+    'ONE_YEAR': '1 year',
+    'THREE_YEARS': '3 years',
+    'NO_UPFRONT': 'No upfront',
+    'PARTIAL_UPFRONT': 'Partial upfront',
+    'ALL_UPFRONT': 'All upfront',
+    'SEVEN_DAYS': '7 days',
+    'THIRTY_DAYS': '30 days',
+    'SIXTY_DAYS': '60 days'
+}
+
+recipients = [
+# add recepient emails to this list
+    ]
+    
+aws_accounts = {
+'123456789111':[{
+    'acc_name':'aws-account-name01',
+    'ano_arn':'arn:aws:ce::123456789111:anomalymonitor/84f93920-r8e90-333f-9320d-48wehr30',
+    'acc_owner':'account.owner@email.com'
+}],
+'123456789011':[{
+    'acc_name':'aws-account-name02',
+    'ano_arn':'arn:aws:ce::123456789011:anomalymonitor/84f93920-480dfr-292f-3020f-48wehr30',
+    'acc_owner':'account.owner@email.com'
+}]
+}
+
+
+##### HTML templates, built once per container #####
+HTML_INTRO = """<html>
+        <head></head>
+        <body>
+        Hi,<br>
+        As part of Cloud Governance, we are sending weekly AWS costing report along with Cost Anomalies and RI recommendations for each of the AWS accounts. The report is generated using the amortized costs of the account. Respective account owners can find any cost anomalies and recommendations of the accounts. There are two excel files attached for the top 10 spends and RI recommendations for each of the AWS accounts.<br>
+        <br>The 'Total cost for all services this week' will be yellow highlighted if the allocated budget is exceeded for the week.<br>
+        <br>This Report will shared once every week, please let us know if any of the recipients needed to be changed or added to this chain. 
+        <br>
+        <br>
+        <h4>AWS costs for the period of {} to {}</h4>
+        <h4>######################################</h4>
+        <div><table style="width:100%">"""
+
+HTML_SIGNATURE = """Thank you,<br>
+    DevOps Team<br>
+    DevOps@company.com"""
+
+HTML_HEAD_CELL = """<td><b style="font-family:'Open Sans';font-size:13px">{}</b></td>"""
+
+
+def html_table(columns, indent):
+
+    # opening of a table with its header row, indented like the markup it replaces
+    return (
+        '<div><table style="width:100%">\n' + ' ' * indent + '<thead><tr>'
+        + ''.join(HTML_HEAD_CELL.format(column) for column in columns)
+        + '</tr></thead>\n' + ' ' * indent + '<tbody>'
+    )
+
+
+ACCOUNT_TABLE = html_table(['Account No', 'Account Name', 'Service Name', 'AWS Cost'], 12)
+
+TREND_ACCOUNT_TABLE = html_table(['Account No', 'Account Name', 'Service Name', 'AWS Cost', 'Previous Week', 'Change', 'Change %', '{} Week Average'.format(TREND_WEEKS)], 12)
+
+ANOMALY_TABLE = html_table(['Service', 'Start Date', 'End Date', 'Region', 'UsageType', 'Max Impact', 'Total Impact'], 16)
+
+TRACKED_ANOMALY_TABLE = html_table(['Service', 'Start Date', 'End Date', 'Region', 'UsageType', 'Max Impact', 'Total Impact', 'Status'], 16)
+
+RI_COLUMNS = {
+    'Amazon Relational Database Service': ['Action', 'Instance Type', 'Region', 'Database', 'License', 'Current Generation', 'Upfront Cost', 'Estimated Monthly Savings'],
+    'Amazon ElastiCache': ['Action', 'Instance Type', 'Region', 'Cache Engine', 'Current Generation', 'Upfront Cost', 'Estimated Monthly Savings'],
+    'Amazon OpenSearch Service': ['Action', 'Instance Type', 'Region', 'Current Generation', 'Upfront Cost', 'Estimated Monthly Savings'],
+    'Amazon Elastic Compute Cloud - Compute': ['Action', 'Instance Type', 'Platform', 'Region', 'Current Generation', 'Upfront Cost', 'Estimated Monthly Savings'],
+    'Amazon Redshift': ['Action', 'Instance Type', 'Region', 'SizeFlex Eligible', 'Current Generation', 'Upfront Cost', 'Estimated Monthly Savings']
+}
+
+RI_TABLES = dict((riservice, html_table(columns, 24)) for riservice, columns in RI_COLUMNS.items())
+
+SAVINGS_PLANS_COLUMNS = ['Action', 'Savings Plan', 'Instance Family', 'Region', 'Upfront Cost', 'Estimated Monthly Savings']
+
+SAVINGS_PLANS_TABLE = html_table(SAVINGS_PLANS_COLUMNS, 24)
+
+ROW_TEMPLATES = dict((n, '<tr>' + '<td>{}</td>' * n + '</tr>') for n in range(1, 9))
+
+BOLD_ROW_TEMPLATES = dict((n, '<tr>' + '<td style=font-weight:bold>{}</td>' * n + '</tr>') for n in range(1, 9))
+
+SPACER_ROW = "<tr height = 20px></tr>"
+
+TABLE_END = SPACER_ROW + "</tbody></table></div>"
+
+WEEK_TOTAL_ROW = "<tr colspan=2><td><span style=font-weight:bold>Total cost for all services this week == ${}</span></td>"
+
+WEEK_TOTAL_EXCEEDED_ROW = "<tr colspan=2><td><span style='font-weight:bold;background-color: yellow'>[!!Weekly budget limit exceeded!!] Total cost for all services this week == ${}</span></td>"
+
+MONTH_TOTAL_ROW = "<tr colspan=2><td><span style=font-weight:bold>Overall spend for the account in this month == ${}</span></td>"
+
+OWNER_HEADING = "<h4>Account Owner: {}</h4>"
+
+ANOMALY_HEADING = "<h4>Anomaly Details for the account {0} ({1}):</h4>"
+
+RI_HEADING = "<h4>RI Recommendations for {0}:</h4>"
+
+RDS_HEADING = "<h4>RI Recommendations for {0} (RDS):</h4>"
+
+SAVINGS_PLANS_HEADING = "<h4>Savings Plans Recommendations for the account {0} ({1}):</h4>"
+
+SUMMARY_HEADING = "<h4>Organization summary for the week</h4>"
+
+OWNER_SUMMARY_TABLE = html_table(['Account Owner', 'AWS Cost'], 12)
+
+SERVICE_SUMMARY_TABLE = html_table(['Service Name', 'AWS Cost'], 12)
+
+ORG_TOTAL_ROW = "<tr colspan=2><td><span style=font-weight:bold>Total cost of the organization this week == ${}</span></td>"
+
+SEPARATOR = "<h4>######################################</h4>"
+
+ATTACHMENT_LINKS = "<br>The reports are too large to attach to this email, they can be downloaded for the next {0} hours:<br>"
+
+ATTACHMENT_LINK = '<a href="{0}">{1}</a><br>'
+
+
+def html_row(*cells):
+    return ROW_TEMPLATES[len(cells)].format(*cells)
+
+
+def html_bold_row(*cells):
+    return BOLD_ROW_TEMPLATES[len(cells)].format(*cells)
+
+
+class HtmlReport:
+
+    # collects the body fragments and encodes them once for the email. With spool_size the
+    # fragments go to a temporary file that moves to disk once it grows past spool_size bytes
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, spool_size=0):
+        self.parts = []
+        self.file = None
+        if spool_size:
+            self.file = tempfile.SpooledTemporaryFile(max_size=spool_size, mode='w+', encoding='utf-8', newline='')
+
+    def write(self, fragment):
+        if self.file is not None:
+            self.file.write(fragment)
+        else:
+            self.parts.append(fragment)
+
+    def chunks(self):
+        if self.file is None:
+            yield from self.parts
+            return
+        self.file.seek(0)
+        while True:
+            chunk = self.file.read(self.CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+    def base64_lines(self):
+        # 57 bytes make one 76 character line, as MIMEText would encode the body
+        pending = b''
+        for chunk in self.chunks():
+            pending += chunk.encode('utf-8')
+            complete = len(pending) - len(pending) % 57
+            if complete:
+                yield base64.encodebytes(pending[:complete]).decode('ascii')
+                pending = pending[complete:]
+        if pending:
+            yield base64.encodebytes(pending).decode('ascii')
+
+    def mime_part(self):
+        # the body is encoded a chunk at a time, neither the whole body nor a utf-8
+        # copy of it is held next to the encoded part
+        from email.mime.nonmultipart import MIMENonMultipart
+        part = MIMENonMultipart('text', 'html', charset='utf-8')
+        part['Content-Transfer-Encoding'] = 'base64'
+        part.set_payload(''.join(self.base64_lines()))
+        return part
+
+
+# boto3.client() shares the default session, which is not thread safe
+_client_lock = threading.Lock()
+
+# assumed role credentials and service clients live at module scope, so warm
+# invocations reuse them instead of going back to STS
+_credentials = {}
+
+_clients = {}
+
+_key_locks = {}
+
+client_cache_stats = {
+    'sts_hits': 0,
+    'sts_misses': 0,
+    'client_hits': 0,
+    'client_misses': 0
+}
+
+# credentials are refreshed this long before they expire
+CREDENTIALS_REFRESH_MARGIN = timedelta(minutes=5)
+
+
+class TokenBucket:
+
+    def __init__(self, rate):
+        self.max_rate = rate
+        self.rate = rate
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # take a token, a negative balance is the queue of callers waiting for theirs
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(max(self.rate, 1.0), self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def throttled(self):
+        with self.lock:
+            self.rate = max(self.max_rate / 16, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.max_rate = rate
+            self.rate = rate
+
+
+class RunMetrics:
+
+    # phase durations per account and for the whole run, counters and byte sizes,
+    # written as embedded metric format lines when the run ends
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.perf_counter()
+            self.run = {}
+            self.accounts = {}
+            self.units = {}
+
+    def add(self, name, value, account=None, unit='Count'):
+        with self.lock:
+            values = self.accounts.setdefault(account, {}) if account else self.run
+            values[name] = values.get(name, 0) + value
+            self.units[name] = unit
+
+    @contextmanager
+    def timer(self, phase, account=None):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(phase, (time.perf_counter() - started) * 1000, account, 'Milliseconds')
+
+    def line(self, values, dimensions=(), **properties):
+        properties['_aws'] = {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': METRICS_NAMESPACE,
+                'Dimensions': [list(dimensions)],
+                'Metrics': [{'Name': name, 'Unit': self.units.get(name, 'Count')} for name in values]
+            }]
+        }
+        properties.update(values)
+        return json.dumps(properties)
+
+    def emit(self, api_stats):
+        # accounts are a property and not a dimension, so the metric count stays flat
+        self.add('Total', (time.perf_counter() - self.started) * 1000, unit='Milliseconds')
+        self.add('Accounts', len(self.accounts))
+        self.add('ApiCalls', sum(api_stats['calls'].values()))
+        self.add('Retries', sum(api_stats['throttles'].values()))
+        self.add('RateLimitWait', api_stats['wait_seconds'] * 1000, unit='Milliseconds')
+        for account, values in self.accounts.items():
+            print(self.line(values, Account=account))
+        for operation, count in api_stats['calls'].items():
+            values = {'ApiCalls': count, 'Retries': api_stats['throttles'].get(operation, 0)}
+            print(self.line(values, ['Operation'], Operation=operation))
+        print(self.line(self.run))
+
+
+metrics = RunMetrics()
+
+
+def timed(phase, account, call, *args, **kwargs):
+    with metrics.timer(phase, account):
+        return call(*args, **kwargs)
+
+
+_buckets = {}
+
+rate_limit_stats = {
+    'calls': {},
+    'throttles': {},
+    'wait_seconds': 0.0
+}
+
+
+def get_bucket(account, service):
+    with _client_lock:
+        key = (account, service)
+        if key not in _buckets:
+            _buckets[key] = TokenBucket(API_RATES[service])
+        return _buckets[key]
+
+
+def _record(operation, throttled=False, wait=0):
+    with _client_lock:
+        stat = 'throttles' if throttled else 'calls'
+        rate_limit_stats[stat][operation] = rate_limit_stats[stat].get(operation, 0) + 1
+        rate_limit_stats['wait_seconds'] += wait
+
+
+def reset_rate_limit_stats():
+    with _client_lock:
+        rate_limit_stats['calls'] = {}
+        rate_limit_stats['throttles'] = {}
+        rate_limit_stats['wait_seconds'] = 0.0
+
+
+def call_with_retry(bucket, operation, call, *args, **kwargs):
+
+    for attempt in range(RETRY_ATTEMPTS):
+        _record(operation, wait=bucket.acquire())
+        try:
+            response = call(*args, **kwargs)
+        except ClientError as e:
+            if e.response['Error']['Code'] not in THROTTLING_ERRORS or attempt == RETRY_ATTEMPTS - 1:
+                raise
+            bucket.throttled()
+            # full jitter, so threads throttled together do not retry together
+            delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+            logging.warning('%s throttled, retrying in %.2fs', operation, delay)
+            time.sleep(delay)
+            _record(operation, throttled=True, wait=delay)
+        else:
+            bucket.succeeded()
+            return response
+
+
+class RateLimitedClient:
+
+    # client methods that do not call the service
+    LOCAL_METHODS = ('get_paginator', 'get_waiter', 'can_paginate', 'generate_presigned_url', 'close')
+
+    def __init__(self, client, account, service):
+        self._client = client
+        self._service = service
+        self._bucket = get_bucket(account, service)
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr) or name.startswith('_') or name in self.LOCAL_METHODS:
+            return attr
+        return partial(call_with_retry, self._bucket, self._service + '.' + name, attr)
+
+
+# botocore retries throttled calls on its own, without taking tokens from the rate limit.
+# Rate limited clients make one attempt per call, call_with_retry does the retries
+SINGLE_ATTEMPT = Config(retries={'total_max_attempts': 1})
+
+
+def new_client(account, resource_type, **kwargs):
+    if resource_type in API_RATES:
+        kwargs['config'] = SINGLE_ATTEMPT
+    with _client_lock:
+        client = boto3.client(resource_type, **kwargs)
+    # every thread calling the same service in the same account shares one rate limit
+    if resource_type in API_RATES:
+        return RateLimitedClient(client, account, resource_type)
+    return client
+
+
+def _key_lock(key):
+    with _client_lock:
+        return _key_locks.setdefault(key, threading.Lock())
+
+
+def _count(stat):
+    with _client_lock:
+        client_cache_stats[stat] += 1
+
+
+def reset_client_cache_stats():
+    with _client_lock:
+        for stat in client_cache_stats:
+            client_cache_stats[stat] = 0
+
+
+# the account id does not change between warm invocations
+_local_account = None
+
+
+def local_account():
+
+    global _local_account
+    with _key_lock(('local_account',)):
+        if _local_account is None:
+            _local_account = LOCAL_ACCOUNT_ID or get_local_client('sts').get_caller_identity()['Account']
+        return _local_account
+
+
+def get_credentials(instance_account_id: str, role_name: str):
+
+    key = (instance_account_id, role_name)
+    # one lock per account and role, so concurrent callers wait for a single assume_role
+    with _key_lock(('sts',) + key):
+        credentials = _credentials.get(key)
+        if credentials and credentials['Expiration'] - CREDENTIALS_REFRESH_MARGIN > datetime.now(timezone.utc):
+            _count('sts_hits')
+            return credentials
+        _count('sts_misses')
+        # Go for STS to assume role for cross account
+        sts_connection = get_local_client('sts')
+        with metrics.timer('AssumeRole', instance_account_id):
+            acct_b = sts_connection.assume_role(
+                RoleArn="arn:aws:iam::{}:role/{}".format(instance_account_id, role_name),
+                RoleSessionName="cross_acct_access_for_lambda"
+            )
+        credentials = acct_b['Credentials']
+        _credentials[key] = credentials
+        return credentials
+
+
+def get_local_client(resource_type: str, instance_region_id: str = None):
+
+    key = ('local', instance_region_id, resource_type)
+    with _key_lock(key):
+        if key in _clients:
+            _count('client_hits')
+            return _clients[key][1]
+        _count('client_misses')
+        client = new_client('local', resource_type, region_name=instance_region_id)
+        _clients[key] = (None, client)
+        return client
+
+
+def get_client(instance_account_id: str, instance_region_id: str, resource_type: str):
+
+    credentials = get_credentials(instance_account_id, ASSUME_ROLE)
+    access_key = credentials['AccessKeyId']
+    key = (instance_account_id, instance_region_id, resource_type)
+    with _key_lock(key):
+        # a pooled client is only reused while it was built from the current credentials
+        pooled = _clients.get(key)
+        if pooled and pooled[0] == access_key:
+            _count('client_hits')
+            return pooled[1]
+        _count('client_misses')
+        # create service client using the assumed role credentials
+        client = new_client(
+            instance_account_id,
+            resource_type,
+            aws_access_key_id=access_key,
+            aws_secret_access_key=credentials['SecretAccessKey'],
+            aws_session_token=credentials['SessionToken'],
+            region_name=instance_region_id
+        )
+        _clients[key] = (access_key, client)
+        return client
+
+    
+def get_week_days(year, week):
+
+    year_start = date(year, 1, 1)
+
+    week_start = year_start + timedelta(days=-year_start.isoweekday(), weeks=week)
+    week_end_title = week_start + timedelta(days=6)
+    week_end = week_start + timedelta(days=7)
+    month_start = week_start.replace(day=1)
+    return week_start, week_end, week_end_title, month_start
+
+
+def finops_budget_name(account, current_year):
+    return 'finops-ACCOUNT_' + account + '_MONTHLY_' + str(current_year)
+
+
+def describe_all_budgets(budget_client, account):
+
+    # every budget the account holds, up to 100 per page. The pages are cached until midnight UTC
+    params = {'AccountId': account, 'MaxResults': 100}
+    while True:
+        response = cached_call(budget_client, 'describe_budgets', account, **params)
+        for budget in response.get('Budgets', []):
+            yield budget
+        if not response.get('NextToken'):
+            return
+        params['NextToken'] = response['NextToken']
+
+
+class BudgetIndex:
+
+    # budgets by the account they belong to and by name, loaded once per account that holds them.
+    # A finops budget kept in another account, like the payer, also counts for the account in its name
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.budgets = {}
+        self.loaded = set()
+
+    def load(self, budget_client, holder):
+        budgets = list(describe_all_budgets(budget_client, holder))
+        with self.lock:
+            self.loaded.add(holder)
+            self.budgets.setdefault(holder, {})
+            for budget in budgets:
+                self.budgets[holder][budget['BudgetName']] = budget
+                name = budget['BudgetName']
+                if name.startswith('finops-ACCOUNT_') and '_MONTHLY_' in name:
+                    account = name[len('finops-ACCOUNT_'):name.index('_MONTHLY_')]
+                    self.budgets.setdefault(account, {})[name] = budget
+
+    def find(self, account, current_year):
+        with self.lock:
+            return self.budgets.get(account, {}).get(finops_budget_name(account, current_year))
+
+    def fallback(self, account):
+        # monthly cost budgets first, then by name, so the choice does not depend on the API order
+        with self.lock:
+            budgets = sorted(
+                self.budgets.get(account, {}).values(),
+                key=lambda budget: (budget.get('TimeUnit') != 'MONTHLY' or budget.get('BudgetType', 'COST') != 'COST', budget['BudgetName'])
+            )
+        return budgets[0] if budgets else None
+
+
+def get_budget(budgets, budget_client, account, current_year, fallback, payer_budgets=None):
+
+    # a finops budget loaded with the payer account budgets saves the call to the account
+    if payer_budgets is not None:
+        payer_budgets.result()
+    budget = budgets.find(account, current_year)
+    if budget is None and account not in budgets.loaded:
+        try:
+            budgets.load(budget_client, account)
+        except ClientError as e:
+            # the account is reported without a budget
+            logging.error('Budgets of %s not read: %s', account, e)
+            return None
+        budget = budgets.find(account, current_year)
+    if budget is None and fallback:
+        # use the budgets of the account when the finops budget is missing
+        budget = budgets.fallback(account)
+    return budget
+
+
+class CostCache:
+
+    def __init__(self, path, key=CACHE_S3_KEY):
+        self.path = path
+        self.key = key
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.committed = time.time()
+        self.stats = {}
+        import sqlite3
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'key TEXT PRIMARY KEY, account TEXT, api TEXT, period TEXT, '
+            'expires REAL, last_used REAL, size INTEGER, value BLOB)'
+        )
+        self.conn.commit()
+
+    def _count(self, api, stat):
+        api_stats = self.stats.setdefault(api, {'hits': 0, 'misses': 0})
+        api_stats[stat] += 1
+
+    def get(self, key, api):
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute('SELECT value, expires FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None or (row[1] is not None and row[1] <= now):
+                self._count(api, 'misses')
+                return None
+            # the new last_used alone is not worth an upload, it goes with the next write
+            self.conn.execute('UPDATE responses SET last_used = ? WHERE key = ?', (now, key))
+            self._count(api, 'hits')
+        return json.loads(zlib.decompress(row[0]))
+
+    def put(self, key, account, api, period, expires, response):
+        value = zlib.compress(json.dumps(response, default=str).encode())
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (key, account, api, period, expires, time.time(), len(value), value)
+            )
+            # committed every CACHE_COMMIT_SECONDS, so a run that times out keeps what it fetched
+            # without paying for a commit per response
+            if time.time() - self.committed >= CACHE_COMMIT_SECONDS:
+                self.conn.commit()
+                self.committed = time.time()
+            self.dirty = True
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+            self.committed = time.time()
+
+    def evict(self):
+        # drop expired entries, then the least recently used ones until the cache fits
+        with self.lock:
+            self.conn.execute('DELETE FROM responses WHERE expires IS NOT NULL AND expires <= ?', (time.time(),))
+            total = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+            evicted = []
+            if total > CACHE_MAX_BYTES:
+                rows = self.conn.execute('SELECT key, size FROM responses ORDER BY last_used').fetchall()
+                for key, size in rows:
+                    if total <= CACHE_MAX_BYTES * 0.9:
+                        break
+                    evicted.append((key,))
+                    total -= size
+                self.conn.executemany('DELETE FROM responses WHERE key = ?', evicted)
+            self.conn.commit()
+            # rewriting the file costs a copy of it, so only when the cache was cut down to size
+            # or enough pages were freed by expired entries
+            free = self.conn.execute('PRAGMA freelist_count').fetchone()[0] * self.conn.execute('PRAGMA page_size').fetchone()[0]
+            if evicted or free > CACHE_VACUUM_BYTES:
+                self.conn.execute('VACUUM')
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {}
+
+    def hit_rate(self):
+        hits = sum(api_stats['hits'] for api_stats in self.stats.values())
+        lookups = hits + sum(api_stats['misses'] for api_stats in self.stats.values())
+        return hits / lookups if lookups else 0.0
+
+    def sync(self):
+        self.evict()
+        if CACHE_S3_BUCKET and self.dirty:
+            upload_file(self.path, CACHE_S3_BUCKET, self.key)
+        self.dirty = False
+
+
+# the cache connection is kept for warm invocations
+_cache = None
+
+_cache_key = CACHE_S3_KEY
+
+_cache_lock = threading.Lock()
+
+
+def shard_cache_key(shard_name):
+
+    # parallel shards would overwrite each other's state in one object, so every shard
+    # keeps its own copy of the cache next to CACHE_S3_KEY
+    root, ext = os.path.splitext(CACHE_S3_KEY)
+    return '{0}-{1}{2}'.format(root, shard_name, ext)
+
+
+def use_cache_key(key):
+
+    global _cache, _cache_key
+    with _cache_lock:
+        if key != _cache_key and _cache is not None and CACHE_S3_BUCKET:
+            # a warm container that ran another shard reopens the cache from the copy of this
+            # one, or starts an empty one, rather than carry the other accounts over
+            _cache.conn.close()
+            _cache = None
+            os.remove(CACHE_PATH)
+        _cache_key = key
+
+
+def get_cache():
+
+    global _cache
+    with _cache_lock:
+        if _cache is None and CACHE_PATH:
+            if CACHE_S3_BUCKET:
+                try:
+                    get_local_client('s3').download_file(CACHE_S3_BUCKET, _cache_key, CACHE_PATH)
+                except ClientError as e:
+                    logging.warning('No cost cache in s3://%s/%s: %s', CACHE_S3_BUCKET, _cache_key, e)
+            _cache = CostCache(CACHE_PATH, _cache_key)
+        return _cache
+
+
+def cache_expiry(api, params):
+
+    now = datetime.now(timezone.utc)
+    if api in ('get_reservation_purchase_recommendation', 'get_savings_plans_purchase_recommendation', 'describe_budgets'):
+        # recommendations are regenerated daily, budget limits are read once a day
+        return datetime.combine(now.date() + timedelta(days=1), datetime.min.time(), timezone.utc).timestamp()
+    if api == 'get_cost_and_usage':
+        period_end = datetime.fromisoformat(params['TimePeriod']['End']).replace(tzinfo=timezone.utc)
+        if period_end + COST_SETTLE_TIME <= now:
+            # closed periods never change
+            return None
+    return (now + CACHE_TTLS[api]).timestamp()
+
+
+def cached_call(client, api, account, **params):
+
+    cache = get_cache()
+    if cache is None:
+        return getattr(client, api)(**params)
+    period = params.get('TimePeriod') or params.get('DateInterval') or {}
+    period = '{}/{}'.format(period.get('Start', period.get('StartDate', '')), period.get('End', period.get('EndDate', '')))
+    key = hashlib.sha256(json.dumps([account, api, params], sort_keys=True, default=str).encode()).hexdigest()
+    response = cache.get(key, api)
+    if response is None:
+        response = getattr(client, api)(**params)
+        response.pop('ResponseMetadata', None)
+        cache.put(key, account, api, period, cache_expiry(api, params), response)
+    return response
+
+
+def paginate(call, result_key, **params):
+
+    # walks NextPageToken lazily, callers that consume the items as they come hold one page at a time
+    while True:
+        response = call(**params)
+        for item in response.get(result_key, []):
+            yield item
+        if not response.get('NextPageToken'):
+            return
+        params['NextPageToken'] = response['NextPageToken']
+
+
+def first_period_groups(results_by_time):
+
+    # the report reads the first period only, its groups can be spread over several pages
+    first_period = None
+    for result in results_by_time:
+        if first_period is None:
+            first_period = result['TimePeriod']['Start']
+        if result['TimePeriod']['Start'] == first_period:
+            for group in result.get('Groups', []):
+                yield group
+
+
+def rank_services(results_by_time):
+
+    # every service of the week by cost, highest first, and their total. The report shows
+    # the top ones, the others still count in the owner and organization totals
+    services = [
+        (service['Keys'][0], to_cents(service['Metrics']['AmortizedCost']['Amount']))
+        for service in first_period_groups(results_by_time)
+    ]
+    # a stable sort, so ties keep the order Cost Explorer returned
+    services.sort(key=lambda x: x[1], reverse=True)
+    return services, sum((amount for service, amount in services), 0)
+
+
+def fetch_week_costs(ce_client, account, start, end):
+
+    # the pages are ranked as they arrive
+    return rank_services(paginate(
+        partial(cached_call, ce_client, 'get_cost_and_usage', account), 'ResultsByTime',
+        TimePeriod={
+            'Start': str(start),
+            'End': str(end)
+        },
+        Granularity='MONTHLY',
+        Metrics=[
+            'AmortizedCost',
+        ],
+        GroupBy=[
+            {
+                'Type': 'DIMENSION',
+                'Key': 'SERVICE'
+            },
+        ],
+    ))
+
+
+def month_to_date(results_by_time):
+
+    for result in results_by_time:
+        uptodate_cost = result['Total']['AmortizedCost']['Amount']
+        return decimal.Decimal(uptodate_cost).quantize(decimal.Decimal('0.00'))
+    return None
+
+
+class CostHistory:
+
+    # daily amortized costs per account and service, stored next to the cached responses
+    def __init__(self, cache):
+        self.cache = cache
+        with cache.lock:
+            cache.conn.execute(
+                'CREATE TABLE IF NOT EXISTS daily_costs ('
+                'account TEXT, service TEXT, day TEXT, amount TEXT, PRIMARY KEY (account, service, day))'
+            )
+            cache.conn.execute(
+                'CREATE TABLE IF NOT EXISTS ingested_days (account TEXT, day TEXT, PRIMARY KEY (account, day))'
+            )
+            cache.conn.execute(
+                'CREATE TABLE IF NOT EXISTS weekly_costs ('
+                'account TEXT, week TEXT, service TEXT, amount TEXT, PRIMARY KEY (account, week, service))'
+            )
+            cache.conn.execute(
+                'CREATE TABLE IF NOT EXISTS ingested_weeks (account TEXT, week TEXT, PRIMARY KEY (account, week))'
+            )
+            cache.conn.commit()
+
+    def missing_days(self, account, start, end):
+        restated = date.today() - timedelta(days=RESTATEMENT_DAYS)
+        with self.cache.lock:
+            rows = self.cache.conn.execute(
+                'SELECT day FROM ingested_days WHERE account = ? AND day >= ? AND day < ?',
+                (account, str(start), str(end))
+            ).fetchall()
+        stored = set(row[0] for row in rows)
+        return [day for day in iter_days(start, end) if str(day) not in stored or day >= restated]
+
+    def store(self, account, start, end, costs):
+        # costs maps day -> [(service, amount)], days of the range without costs are stored as empty
+        with self.cache.lock:
+            self.cache.conn.execute(
+                'DELETE FROM daily_costs WHERE account = ? AND day >= ? AND day < ?',
+                (account, str(start), str(end))
+            )
+            self.cache.conn.executemany(
+                'INSERT OR REPLACE INTO daily_costs VALUES (?, ?, ?, ?)',
+                [(account, service, day, amount) for day, services in costs.items() for service, amount in services]
+            )
+            self.cache.conn.executemany(
+                'INSERT OR REPLACE INTO ingested_days VALUES (?, ?)',
+                [(account, str(day)) for day in iter_days(start, end)]
+            )
+            self.cache.conn.commit()
+            self.cache.dirty = True
+
+    def service_costs(self, account, start, end):
+        with self.cache.lock:
+            rows = self.cache.conn.execute(
+                'SELECT service, amount FROM daily_costs WHERE account = ? AND day >= ? AND day < ? ORDER BY service',
+                (account, str(start), str(end))
+            ).fetchall()
+        services = {}
+        for service, amount in rows:
+            services[service] = services.get(service, 0) + decimal.Decimal(amount)
+        return services
+
+    def missing_weeks(self, account, weeks):
+        with self.cache.lock:
+            rows = self.cache.conn.execute(
+                'SELECT week FROM ingested_weeks WHERE account = ? AND week >= ? AND week <= ?',
+                (account, str(min(weeks)), str(max(weeks)))
+            ).fetchall()
+        stored = set(row[0] for row in rows)
+        return [week for week in weeks if str(week) not in stored]
+
+    def store_week(self, account, week, services):
+        # the ranked services of a week as the report showed them
+        with self.cache.lock:
+            self.cache.conn.execute('DELETE FROM weekly_costs WHERE account = ? AND week = ?', (account, str(week)))
+            self.cache.conn.executemany(
+                'INSERT OR REPLACE INTO weekly_costs VALUES (?, ?, ?, ?)',
+                [(account, str(week), service, str(amount)) for service, amount in services]
+            )
+            self.cache.conn.execute('INSERT OR REPLACE INTO ingested_weeks VALUES (?, ?)', (account, str(week)))
+            self.cache.conn.commit()
+            self.cache.dirty = True
+
+    def week_costs(self, account, weeks):
+        # service -> amount for each of the weeks, in the given order
+        with self.cache.lock:
+            rows = self.cache.conn.execute(
+                'SELECT week, service, amount FROM weekly_costs WHERE account = ? AND week >= ? AND week <= ?',
+                (account, str(min(weeks)), str(max(weeks)))
+            ).fetchall()
+        costs = dict((str(week), {}) for week in weeks)
+        for week, service, amount in rows:
+            if week in costs:
+                costs[week][service] = decimal.Decimal(amount)
+        return [costs[str(week)] for week in weeks]
+
+
+# the history shares the cache connection and is kept for warm invocations
+_history = None
+
+
+def cost_history():
+
+    global _history
+    cache = get_cache()
+    if cache is None:
+        return None
+    with _cache_lock:
+        if _history is None or _history.cache is not cache:
+            _history = CostHistory(cache)
+        return _history
+
+
+def get_history():
+
+    if COST_INGESTION_MODE != 'incremental':
+        return None
+    return cost_history()
+
+
+def get_trend_history():
+
+    # the trend columns only read weeks stored by earlier runs, so they need the cache
+    if not TREND_WEEKS:
+        return None
+    return cost_history()
+
+
+def trend_enabled():
+
+    # the columns are shown whenever the cache can hold the previous weeks
+    return TREND_WEEKS > 0 and bool(CACHE_PATH)
+
+
+def trend_weeks(start_week):
+    return [start_week - timedelta(weeks=week) for week in range(1, TREND_WEEKS + 1)]
+
+
+class AnomalyState:
+
+    # the anomalies of each account as last reported: the week they were first and last
+    # reported, their total impact then and the impact of the report before, so a second
+    # run in the same week marks them the same way. Resolved anomalies stay for one week
+    def __init__(self, cache):
+        self.cache = cache
+        with cache.lock:
+            cache.conn.execute(
+                'CREATE TABLE IF NOT EXISTS anomaly_state ('
+                'account TEXT, anomaly_id TEXT, first_week TEXT, week TEXT, impact REAL, prior_impact REAL, '
+                'resolved INTEGER, anomaly TEXT, PRIMARY KEY (account, anomaly_id))'
+            )
+            cache.conn.commit()
+
+    def track(self, account, week, anomalies, complete=True):
+        # complete is False when the anomaly query of the account failed, the anomalies it
+        # did not return are then kept as they are instead of being reported as resolved
+        week = str(week)
+        with self.cache.lock:
+            rows = self.cache.conn.execute(
+                'SELECT anomaly_id, first_week, week, impact, prior_impact, resolved, anomaly FROM anomaly_state WHERE account = ?',
+                (account,)
+            ).fetchall()
+        stored = dict((row[0], row[1:]) for row in rows)
+        updates = []
+        for anomaly in anomalies:
+            first_week, last_week, impact, prior_impact, resolved, record = stored.pop(anomaly.anomaly_id, (week, week, None, None, 0, None))
+            if last_week != week:
+                # the first run of the week compares with the last report, reruns with the same one
+                prior_impact = impact
+            if first_week == week or prior_impact is None:
+                anomaly.status = 'New'
+            elif anomaly.total_impact > prior_impact + 0.005:
+                anomaly.status = 'Grown'
+            else:
+                anomaly.status = 'Ongoing'
+            updates.append((account, anomaly.anomaly_id, first_week, week, anomaly.total_impact, prior_impact, 0, json.dumps(asdict(anomaly))))
+        # anomalies of an earlier report that are gone are reported as resolved once
+        resolved = []
+        for anomaly_id, (first_week, last_week, impact, prior_impact, was_resolved, record) in (stored.items() if complete else ()):
+            if was_resolved and last_week != week:
+                continue
+            anomaly = Anomaly(**dict(json.loads(record), status='Resolved'))
+            anomaly.root_causes = [tuple(cause) for cause in anomaly.root_causes]
+            resolved.append(anomaly)
+            if not was_resolved:
+                updates.append((account, anomaly_id, first_week, week, impact, prior_impact, 1, record))
+        with self.cache.lock:
+            self.cache.conn.execute(
+                'DELETE FROM anomaly_state WHERE account = ? AND resolved = 1 AND week < ?', (account, week)
+            )
+            self.cache.conn.executemany('INSERT OR REPLACE INTO anomaly_state VALUES (?, ?, ?, ?, ?, ?, ?, ?)', updates)
+            self.cache.conn.commit()
+            self.cache.dirty = True
+        if ANOMALY_TRACKING == 'changes':
+            anomalies = [anomaly for anomaly in anomalies if anomaly.status != 'Ongoing']
+        return anomalies + resolved
+
+
+# kept for warm invocations like the history
+_anomaly_state = None
+
+
+def get_anomaly_state():
+
+    global _anomaly_state
+    cache = get_cache()
+    if ANOMALY_TRACKING not in ('mark', 'changes') or cache is None:
+        return None
+    with _cache_lock:
+        if _anomaly_state is None or _anomaly_state.cache is not cache:
+            _anomaly_state = AnomalyState(cache)
+        return _anomaly_state
+
+
+def anomaly_tracking():
+    return ANOMALY_TRACKING in ('mark', 'changes') and bool(CACHE_PATH)
+
+
+def iter_days(start, end):
+
+    day = start
+    while day < end:
+        yield day
+        day += timedelta(days=1)
+
+
+def month_periods(start, end):
+
+    # the calendar months a MONTHLY query over start..end returns
+    while start < end:
+        next_month = (start.replace(day=1) + timedelta(days=32)).replace(day=1)
+        yield start, min(next_month, end)
+        start = next_month
+
+
+def query_daily_costs(ce_client, start, end, group_by, cost_filter=None):
+
+    params = {
+        'TimePeriod': {
+            'Start': str(start),
+            'End': str(end)
+        },
+        'Granularity': 'DAILY',
+        'Metrics': [
+            'AmortizedCost',
+        ],
+        'GroupBy': [{'Type': 'DIMENSION', 'Key': key} for key in group_by]
+    }
+    if cost_filter:
+        params['Filter'] = cost_filter
+    # the daily costs are stored by CostHistory, so the responses are not cached
+    for result in paginate(ce_client.get_cost_and_usage, 'ResultsByTime', **params):
+        for group in result.get('Groups', []):
+            yield result['TimePeriod']['Start'], group['Keys'], group['Metrics']['AmortizedCost']['Amount']
+
+
+def derive_costs(history, account, start_week, end_week, month_start_date):
+
+    # build the responses of the weekly and month to date MONTHLY queries from the daily costs
+    results = {'ResultsByTime': []}
+    for start, end in month_periods(start_week, end_week):
+        services = history.service_costs(account, start, end)
+        results['ResultsByTime'].append({
+            'TimePeriod': {'Start': str(start), 'End': str(end)},
+            'Groups': [
+                {'Keys': [service], 'Metrics': {'AmortizedCost': {'Amount': str(amount), 'Unit': 'USD'}}}
+                for service, amount in services.items()
+            ]
+        })
+    month_results = {'ResultsByTime': []}
+    for start, end in month_periods(month_start_date, end_week):
+        services = history.service_costs(account, start, end)
+        month_results['ResultsByTime'].append({
+            'TimePeriod': {'Start': str(start), 'End': str(end)},
+            'Total': {'AmortizedCost': {'Amount': str(sum(services.values(), decimal.Decimal(0))), 'Unit': 'USD'}}
+        })
+    return results, month_results
+
+
+def get_incremental_costs(history, ce_client, account, start_week, end_week, month_start_date):
+
+    missing = history.missing_days(account, month_start_date, end_week)
+    if missing:
+        start, end = missing[0], missing[-1] + timedelta(days=1)
+        costs = {}
+        for day, keys, amount in query_daily_costs(ce_client, start, end, ['SERVICE']):
+            costs.setdefault(day, []).append((keys[0], amount))
+        history.store(account, start, end, costs)
+    return derive_costs(history, account, start_week, end_week, month_start_date)
+
+
+def get_incremental_org_costs(history, ce_client, accounts, start_week, end_week, month_start_date):
+
+    # one daily query from the payer account over the days any of the accounts is missing
+    missing = {}
+    for account in accounts:
+        days = history.missing_days(account, month_start_date, end_week)
+        if days:
+            missing[account] = days
+    if missing:
+        start = min(days[0] for days in missing.values())
+        end = max(days[-1] for days in missing.values()) + timedelta(days=1)
+        cost_filter = {'Dimensions': {'Key': 'LINKED_ACCOUNT', 'Values': list(missing)}}
+        costs = {}
+        for day, keys, amount in query_daily_costs(ce_client, start, end, ['LINKED_ACCOUNT', 'SERVICE'], cost_filter):
+            costs.setdefault(keys[0], {}).setdefault(day, []).append((keys[1], amount))
+        for account in missing:
+            history.store(account, start, end, costs.get(account, {}))
+    return dict(
+        (account, derive_costs(history, account, start_week, end_week, month_start_date))
+        for account in accounts
+    )
+
+
+def query_by_linked_account(ce_client, accounts, start, end, group_keys):
+
+    group_by = [{'Type': 'DIMENSION', 'Key': 'LINKED_ACCOUNT'}]
+    for key in group_keys:
+        group_by.append({'Type': 'DIMENSION', 'Key': key})
+    params = {
+        'TimePeriod': {
+            'Start': str(start),
+            'End': str(end)
+        },
+        'Granularity': 'MONTHLY',
+        'Metrics': [
+            'AmortizedCost',
+        ],
+        'GroupBy': group_by,
+        'Filter': {
+            'Dimensions': {
+                'Key': 'LINKED_ACCOUNT',
+                'Values': list(accounts)
+            }
+        }
+    }
+    # groups of one period can be spread over several pages. Every page is kept here,
+    # the groups of all accounts are needed before they can be split
+    periods = []
+    by_start = {}
+    for result in paginate(partial(cached_call, ce_client, 'get_cost_and_usage', 'organization'), 'ResultsByTime', **params):
+        period_start = result['TimePeriod']['Start']
+        if period_start not in by_start:
+            by_start[period_start] = (result['TimePeriod'], {})
+            periods.append(by_start[period_start])
+        for group in result.get('Groups', []):
+            by_start[period_start][1].setdefault(group['Keys'][0], []).append(group)
+    return periods
+
+
+def account_periods(periods, account):
+
+    # the periods of a query grouped by linked account, as the account would have returned them
+    return [
+        {
+            'TimePeriod': time_period,
+            'Groups': [{'Keys': group['Keys'][1:], 'Metrics': group['Metrics']} for group in groups.get(account, [])]
+        }
+        for time_period, groups in periods
+    ]
+
+
+def get_org_costs(ce_client, accounts, start_week, end_week, month_start_date):
+
+    # split the payer account results into the responses each account would have returned
+    weekly = query_by_linked_account(ce_client, accounts, start_week, end_week, ['SERVICE'])
+    monthly = query_by_linked_account(ce_client, accounts, month_start_date, end_week, [])
+    org_costs = {}
+    for account in accounts:
+        results = {'ResultsByTime': account_periods(weekly, account)}
+        month_results = {'ResultsByTime': []}
+        for time_period, groups in monthly:
+            if account in groups:
+                total = groups[account][0]['Metrics']
+            else:
+                total = {'AmortizedCost': {'Amount': '0', 'Unit': 'USD'}}
+            month_results['ResultsByTime'].append({
+                'TimePeriod': time_period,
+                'Total': total
+            })
+        org_costs[account] = (results, month_results)
+    return org_costs
+
+
+def get_trend_costs(history, ce_client, account, start_week):
+
+    # weeks no earlier run stored are fetched once, usually only on the first run
+    weeks = trend_weeks(start_week)
+    for week in history.missing_weeks(account, weeks):
+        services, total_cost = fetch_week_costs(ce_client, account, week, week + timedelta(weeks=1))
+        history.store_week(account, week, services)
+    return history.week_costs(account, weeks)
+
+
+def get_org_trend_costs(history, ce_client, accounts, start_week):
+
+    # one payer account query per week that any of the accounts is missing
+    weeks = trend_weeks(start_week)
+    missing = {}
+    for account in accounts:
+        for week in history.missing_weeks(account, weeks):
+            missing.setdefault(week, []).append(account)
+    for week, week_accounts in sorted(missing.items()):
+        periods = query_by_linked_account(ce_client, week_accounts, week, week + timedelta(weeks=1), ['SERVICE'])
+        for account in week_accounts:
+            services, total_cost = rank_services(account_periods(periods, account))
+            history.store_week(account, week, services)
+    return dict((account, history.week_costs(account, weeks)) for account in accounts)
+
+
+def fetch_all(call, result_key, **params):
+    return list(paginate(call, result_key, **params))
+
+
+def fetch_savings_plans(call, **params):
+
+    # the details are nested in the recommendation, the page token is at the top of the response
+    details = []
+    while True:
+        response = call(**params)
+        recommendation = response.get('SavingsPlansPurchaseRecommendation', {})
+        details.extend(recommendation.get('SavingsPlansPurchaseRecommendationDetails', []))
+        if not response.get('NextPageToken'):
+            return details
+        params['NextPageToken'] = response['NextPageToken']
+
+
+##### Report records, filled by the collectors and read by the renderers #####
+@dataclass(slots=True)
+class ServiceCost:
+    service: str
+    amount: decimal.Decimal
+    previous: decimal.Decimal = None
+    average: decimal.Decimal = None
+
+    def trend_columns(self):
+        # previous week, change, change percentage and trailing average, '-' without history
+        if self.previous is None:
+            return ('-', '-', '-', '-')
+        change = self.amount - self.previous
+        percent = '{:+}%'.format((change * 100 / abs(self.previous)).quantize(decimal.Decimal('0.1'))) if self.previous else '-'
+        return (str(self.previous), '{:+}'.format(change), percent, str(self.average))
+
+
+@dataclass(slots=True)
+class Anomaly:
+    service: str
+    start_date: str
+    end_date: str
+    region: str
+    usage_type: str
+    max_impact: float
+    total_impact: float
+    # (service, region, usage type) of the root causes after the first one
+    root_causes: list = field(default_factory=list)
+    anomaly_id: str = None
+    status: str = None
+
+
+@dataclass(slots=True)
+class RIRecommendation:
+    action: str
+    instance_type: str
+    details: tuple
+    upfront_cost: decimal.Decimal
+    monthly_savings: decimal.Decimal
+
+    def columns(self):
+        # values in the order of RI_COLUMNS
+        return (self.action, self.instance_type) + self.details + (str(self.upfront_cost), str(self.monthly_savings))
+
+
+@dataclass(slots=True)
+class RIOptions:
+    riservice: str
+    instance_type: str
+    details: tuple
+    savings: list
+    best: int
+
+    def rows(self):
+        # one row per lookback with the monthly savings of every term and payment option,
+        # the best option of the instance is named on the row of its lookback
+        columns = len(RI_TERMS) * len(RI_PAYMENT_OPTIONS)
+        for start in range(0, len(RI_MATRIX), columns):
+            best = ''
+            if start <= self.best < start + columns:
+                term, payment, lookback = RI_MATRIX[self.best]
+                best = '{0}, {1}'.format(RI_OPTION_LABELS[term], RI_OPTION_LABELS[payment])
+            yield (
+                [RI_SHEET_TITLES[self.riservice], self.instance_type, ', '.join(self.details), RI_OPTION_LABELS[RI_MATRIX[start][2]]]
+                + [str(savings) if savings is not None else '-' for savings in self.savings[start:start + columns]]
+                + [best]
+            )
+
+
+@dataclass(slots=True)
+class SavingsPlanRecommendation:
+    plan_type: str
+    instance_family: str
+    region: str
+    hourly_commitment: decimal.Decimal
+    upfront_cost: decimal.Decimal
+    monthly_savings: decimal.Decimal
+
+    def columns(self):
+        # values in the order of SAVINGS_PLANS_COLUMNS
+        return (
+            'Commit ${0}/hour'.format(self.hourly_commitment), SAVINGS_PLANS_TITLES[self.plan_type], self.instance_family,
+            self.region, str(self.upfront_cost), str(self.monthly_savings)
+        )
+
+
+@dataclass(slots=True)
+class AccountReport:
+    account: str
+    name: str
+    owner: str
+    services: list
+    total_cost: decimal.Decimal
+    month_cost: decimal.Decimal
+    weekly_budget: decimal.Decimal = None
+    anomalies: list = field(default_factory=list)
+    ri_recommendations: dict = field(default_factory=dict)
+    savings_plans: list = field(default_factory=list)
+    ri_options: list = field(default_factory=list)
+
+    @property
+    def owner_name(self):
+        return self.owner.split('@')[0]
+
+    @property
+    def top_services(self):
+        # services holds every service of the week, highest cost first
+        return self.services[:TOP_SERVICES]
+
+
+# instance details key, instance type field and the other fields shown for each RI service
+RI_DETAILS = {
+    'Amazon Relational Database Service': ('RDSInstanceDetails', 'InstanceType', ['Region', 'DatabaseEngine', 'LicenseModel', 'CurrentGeneration']),
+    'Amazon ElastiCache': ('ElastiCacheInstanceDetails', 'NodeType', ['Region', 'ProductDescription', 'CurrentGeneration']),
+    'Amazon OpenSearch Service': ('ESInstanceDetails', 'InstanceSize', ['Region', 'CurrentGeneration']),
+    'Amazon Elastic Compute Cloud - Compute': ('EC2InstanceDetails', 'InstanceType', ['Platform', 'Region', 'CurrentGeneration']),
+    'Amazon Redshift': ('RedshiftInstanceDetails', 'NodeType', ['Region', 'SizeFlexEligible', 'CurrentGeneration'])
+}
+
+
+def to_cents(amount):
+    return decimal.Decimal(amount).quantize(decimal.Decimal('0.00'))
+
+
+def weekly_budget(budget):
+
+    # a quarter of the finops monthly budget, or of the fallback budget of the account
+    if budget is None:
+        return None
+    return to_cents(decimal.Decimal(budget['BudgetLimit'].get('Amount')) / 4)
+
+
+def parse_anomaly(detail):
+
+    root_causes = detail['RootCauses'] or [{}]
+    root_cause = root_causes[0]
+    return Anomaly(
+        service=root_cause.get('Service', detail.get('DimensionValue', '-')),
+        start_date=detail['AnomalyStartDate'].split("T")[0],
+        end_date=detail['AnomalyEndDate'].split("T")[0],
+        region=root_cause.get('Region', '-'),
+        usage_type=root_cause.get('UsageType', '-'),
+        max_impact=detail['Impact']['MaxImpact'],
+        total_impact=detail['Impact']['TotalImpact'],
+        root_causes=[
+            (cause.get('Service', '-'), cause.get('Region', '-'), cause.get('UsageType', '-'))
+            for cause in root_causes[1:]
+        ],
+        anomaly_id=detail.get('AnomalyId')
+    )
+
+
+def parse_ri_recommendation(riservice, detail):
+
+    details_key, type_field, fields = RI_DETAILS[riservice]
+    instance = detail['InstanceDetails'][details_key]
+    return RIRecommendation(
+        action="Buy {0} {1}".format(detail['RecommendedNumberOfInstancesToPurchase'], instance[type_field]),
+        instance_type=instance[type_field],
+        details=tuple(str(instance[name]) for name in fields),
+        upfront_cost=to_cents(detail['UpfrontCost']),
+        monthly_savings=to_cents(detail['EstimatedMonthlySavingsAmount'])
+    )
+
+
+def service_cost(service, amount, trend_costs=None):
+
+    # previous week and trailing average of the service from the stored weeks
+    if not trend_costs:
+        return ServiceCost(service, amount)
+    weekly = [costs.get(service, 0) for costs in trend_costs]
+    return ServiceCost(service, amount, to_cents(weekly[0]), to_cents(sum(weekly, 0) / len(weekly)))
+
+
+def parse_ri_matrix(riservice, results):
+
+    # results holds the recommendations of every option of RI_MATRIX. The same instance type,
+    # region and details can be recommended under several options, the highest estimated
+    # monthly savings wins. They are net of the amortized upfront cost, so terms compare directly
+    instances = {}
+    for index, option in enumerate(RI_MATRIX):
+        for recommendation in results[option]:
+            for detail in recommendation['RecommendationDetails']:
+                parsed = parse_ri_recommendation(riservice, detail)
+                options = instances.setdefault((parsed.instance_type, parsed.details), [None] * len(RI_MATRIX))
+                if options[index] is None or parsed.monthly_savings > options[index].monthly_savings:
+                    options[index] = parsed
+    recommendations = []
+    ri_options = []
+    for (instance_type, details), options in instances.items():
+        best = max((index for index, parsed in enumerate(options) if parsed is not None), key=lambda index: options[index].monthly_savings)
+        term, payment, lookback = RI_MATRIX[best]
+        recommendation = options[best]
+        recommendation.action = '{0} ({1}, {2}, {3} lookback)'.format(
+            recommendation.action, RI_OPTION_LABELS[term], RI_OPTION_LABELS[payment], RI_OPTION_LABELS[lookback]
+        )
+        recommendations.append(recommendation)
+        ri_options.append(RIOptions(
+            riservice, instance_type, details, [parsed.monthly_savings if parsed is not None else None for parsed in options], best
+        ))
+    recommendations.sort(key=lambda recommendation: recommendation.monthly_savings, reverse=True)
+    return recommendations, ri_options
+
+
+def parse_savings_plan(plan_type, detail):
+
+    # Compute Savings Plans apply to any instance family and region
+    plan = detail.get('SavingsPlansDetails', {})
+    return SavingsPlanRecommendation(
+        plan_type=plan_type,
+        instance_family=plan.get('InstanceFamily', '-'),
+        region=plan.get('Region', '-'),
+        hourly_commitment=decimal.Decimal(detail['HourlyCommitmentToPurchase']).quantize(decimal.Decimal('0.001')),
+        upfront_cost=to_cents(detail['UpfrontCost']),
+        monthly_savings=to_cents(detail['EstimatedMonthlySavingsAmount'])
+    )
+
+
+def build_account_report(account, services, total_cost, month_cost, budget, anomalies, ri_results, trend_costs=None, sp_results=None):
+
+    # anomalies by max impact and RI recommendations by savings, highest first
+    anomalies = sorted((parse_anomaly(detail) for detail in anomalies), key=lambda anomaly: anomaly.max_impact, reverse=True)
+    ri_recommendations = {}
+    ri_options = []
+    for riservice in ri_services:
+        if riservice not in RI_DETAILS:
+            continue
+        if RI_RECOMMENDATION_MODE == 'matrix':
+            ri_recommendations[riservice], options = parse_ri_matrix(riservice, ri_results[riservice])
+            ri_options.extend(options)
+            continue
+        details = [detail for recommendation in ri_results[riservice] for detail in recommendation['RecommendationDetails']]
+        details.sort(key=lambda detail: decimal.Decimal(detail['EstimatedMonthlySavingsAmount']), reverse=True)
+        ri_recommendations[riservice] = [parse_ri_recommendation(riservice, detail) for detail in details]
+    # both Savings Plans types in one list, by savings
+    savings_plans = [(plan_type, detail) for plan_type, details in (sp_results or {}).items() for detail in details]
+    savings_plans.sort(key=lambda plan: decimal.Decimal(plan[1]['EstimatedMonthlySavingsAmount']), reverse=True)
+    return AccountReport(
+        account=account,
+        name=aws_accounts[account][0]['acc_name'],
+        owner=aws_accounts[account][0]['acc_owner'],
+        services=[service_cost(service, amount, trend_costs) for service, amount in services],
+        total_cost=total_cost,
+        month_cost=month_cost if month_cost is not None else to_cents(0),
+        weekly_budget=weekly_budget(budget),
+        anomalies=anomalies,
+        ri_recommendations=ri_recommendations,
+        savings_plans=[parse_savings_plan(plan_type, detail) for plan_type, detail in savings_plans],
+        ri_options=ri_options
+    )
+
+
+class AccountClient:
+
+    # assumes the role of the account on the first call that reaches the service, so an
+    # account served from the cache does not go to STS
+    def __init__(self, account, resource_type):
+        self._account = account
+        self._resource_type = resource_type
+
+    def __getattr__(self, name):
+        return getattr(get_client(self._account, 'us-east-1', self._resource_type), name)
+
+
+def account_client(account, resource_type):
+
+    # the account the Lambda runs in needs no role
+    if account == local_account():
+        return get_local_client(resource_type)
+    return AccountClient(account, resource_type)
+
+
+def anomaly_params(start_week, end_week):
+
+    params = {
+        'DateInterval': {
+            'StartDate': str(start_week),
+            'EndDate': str(end_week)
+        }
+    }
+    if ANOMALY_MIN_IMPACT:
+        params['TotalImpact'] = {'NumericOperator': 'GREATER_THAN_OR_EQUAL', 'StartValue': ANOMALY_MIN_IMPACT}
+    return params
+
+
+def fetch_org_anomalies(api_pool, accounts, start_week, end_week):
+
+    # one paginated query per distinct monitor, from the account that owns it, or one
+    # query from the payer account for every monitor it has, each fetched on the pool.
+    # Every query comes with the accounts whose monitor it reads
+    if ANOMALY_QUERY_MODE == 'organization':
+        ce_client = get_local_client('ce')
+        return [(list(accounts), api_pool.submit(
+            timed, 'Anomalies', None, fetch_all, partial(cached_call, ce_client, 'get_anomalies', 'organization'), 'Anomalies',
+            **anomaly_params(start_week, end_week)
+        ))]
+    monitors = {}
+    for account in accounts:
+        monitors.setdefault(aws_accounts[account][0]['ano_arn'], []).append(account)
+    sources = []
+    for monitor_arn, monitor_accounts in monitors.items():
+        owner = monitor_arn.split(':')[4]
+        ce_client = account_client(owner, 'ce')
+        sources.append((monitor_accounts, api_pool.submit(
+            timed, 'Anomalies', owner, fetch_all, partial(cached_call, ce_client, 'get_anomalies', owner), 'Anomalies',
+            MonitorArn = monitor_arn,
+            **anomaly_params(start_week, end_week)
+        )))
+    return sources
+
+
+def split_anomalies(sources, accounts):
+
+    # every anomaly goes to the accounts of its root causes, with only their own root causes.
+    # Anomalies without a linked account go to the account of a linked account monitor, or to
+    # the accounts that use the monitor. An anomaly seen by several monitors is kept once.
+    # Accounts whose query failed get None
+    by_account = dict((account, []) for account in accounts)
+    monitors = {}
+    for account in accounts:
+        monitors.setdefault(aws_accounts[account][0]['ano_arn'], []).append(account)
+    seen = set()
+    failed = set()
+    for source_accounts, future in sources:
+        try:
+            details = future.result()
+        except ClientError as e:
+            logging.error('Anomalies of %s not read: %s', source_accounts, e)
+            failed.update(source_accounts)
+            continue
+        for detail in details:
+            if detail['AnomalyId'] in seen:
+                continue
+            seen.add(detail['AnomalyId'])
+            root_causes = detail.get('RootCauses') or []
+            linked = [cause.get('LinkedAccount') for cause in root_causes if cause.get('LinkedAccount') in by_account]
+            if linked:
+                targets = list(dict.fromkeys(linked))
+            elif detail.get('DimensionValue') in by_account:
+                targets = [detail['DimensionValue']]
+            else:
+                targets = monitors.get(detail.get('MonitorArn'), [])
+            for account in targets:
+                causes = [cause for cause in root_causes if cause.get('LinkedAccount') == account]
+                by_account[account].append(dict(detail, RootCauses=causes or root_causes))
+    for account in failed:
+        by_account[account] = None
+    return by_account
+
+
+def result_of(futures):
+
+    # the result of a future, or of each future of a dict of them
+    if isinstance(futures, dict):
+        return dict((key, future.result()) for key, future in futures.items())
+    return futures.result()
+
+
+def collect_account(account, start_week, end_week, month_start_date, current_year, api_pool, budgets, payer_budgets=None, org_costs=None, history=None, trend=None, org_trend=None, org_anomalies=None):
+
+    ce_client = account_client(account, 'ce')
+    budget_client = account_client(account, 'budgets')
+
+    # the calls of one account do not depend on each other, so they all go to the pool
+    if org_costs is None and history is not None:
+        ##### Getting new daily costs, week and month to date are derived from them #####
+        incremental = api_pool.submit(timed, 'CostFetch', account, get_incremental_costs, history, ce_client, account, start_week, end_week, month_start_date)
+    elif org_costs is None:
+        ##### Getting Cost and Usage data #####
+        weekly = api_pool.submit(timed, 'CostFetch', account, fetch_week_costs, ce_client, account, start_week, end_week)
+        ##### Getting up to date cost
+        month_cost = api_pool.submit(
+            timed, 'CostFetch', account, month_to_date, paginate(
+                partial(cached_call, ce_client, 'get_cost_and_usage', account), 'ResultsByTime',
+                TimePeriod={
+                    'Start': str(month_start_date),
+                    'End': str(end_week)
+                },
+                Granularity='MONTHLY',
+                Metrics=[
+                    'AmortizedCost',
+                ]
+            )
+        )
+    ##### Getting the previous weeks of the trend columns #####
+    if trend is not None and org_trend is None:
+        trend_costs = api_pool.submit(timed, 'TrendFetch', account, get_trend_costs, trend, ce_client, account, start_week)
+    ##### Getting monthly budget limit #####
+    budget = api_pool.submit(timed, 'Budget', account, get_budget, budgets, budget_client, account, current_year, account != local_account(), payer_budgets)
+    ##### Getting Anomaly data #####
+    if org_anomalies is None:
+        anomalies = api_pool.submit(
+            timed, 'Anomalies', account, fetch_all, partial(cached_call, ce_client, 'get_anomalies', account), 'Anomalies',
+            MonitorArn = aws_accounts[account][0]['ano_arn'],
+            **anomaly_params(start_week, end_week)
+        )
+    ##### Getting RI recommendations #####
+    ri_results = {}
+    for riservice in ri_services:
+        if RI_RECOMMENDATION_MODE == 'matrix':
+            # every option is its own request, they all wait for the Cost Explorer rate limit of the account
+            if riservice in RI_DETAILS:
+                ri_results[riservice] = dict(
+                    ((term, payment, lookback), api_pool.submit(
+                        timed, 'RI ' + riservice, account, fetch_all, partial(cached_call, ce_client, 'get_reservation_purchase_recommendation', account), 'Recommendations',
+                        AccountId = account,
+                        Service = riservice,
+                        TermInYears = term,
+                        LookbackPeriodInDays = lookback,
+                        PaymentOption = payment
+                    ))
+                    for term, payment, lookback in RI_MATRIX
+                )
+            continue
+        ri_results[riservice] = api_pool.submit(
+            timed, 'RI ' + riservice, account, fetch_all, partial(cached_call, ce_client, 'get_reservation_purchase_recommendation', account), 'Recommendations',
+            AccountId = account,
+            Service = riservice,
+            TermInYears = 'ONE_YEAR',
+            LookbackPeriodInDays = 'THIRTY_DAYS',
+            PaymentOption = 'ALL_UPFRONT'
+        )
+    ##### Getting Savings Plans recommendations #####
+    sp_results = {}
+    for plan_type in savings_plans_types:
+        sp_results[plan_type] = api_pool.submit(
+            timed, 'SP ' + plan_type, account, fetch_savings_plans, partial(cached_call, ce_client, 'get_savings_plans_purchase_recommendation', account),
+            SavingsPlansType = plan_type,
+            AccountScope = 'LINKED',
+            TermInYears = 'ONE_YEAR',
+            LookbackPeriodInDays = 'THIRTY_DAYS',
+            PaymentOption = 'ALL_UPFRONT'
+        )
+
+    if org_costs is not None or history is not None:
+        if org_costs is not None:
+            results, month_results = org_costs.result()[account]
+        else:
+            results, month_results = incremental.result()
+        services, total_cost = rank_services(results['ResultsByTime'])
+        month_cost = month_to_date(month_results['ResultsByTime'])
+    else:
+        services, total_cost = weekly.result()
+        month_cost = month_cost.result()
+    if trend is not None:
+        # the week is kept as the report shows it, for the trend columns of the next runs
+        trend.store_week(account, start_week, services)
+        trend_costs = org_trend.result()[account] if org_trend is not None else trend_costs.result()
+    else:
+        trend_costs = None
+    if org_anomalies is not None:
+        anomalies = org_anomalies.result()[account]
+    else:
+        try:
+            anomalies = anomalies.result()
+        except ClientError as e:
+            logging.error('Anomalies of %s not read: %s', account, e)
+            anomalies = None
+    # a failed anomaly query leaves the account without anomalies this week
+    anomalies_read = anomalies is not None
+    report = build_account_report(
+        account, services, total_cost, month_cost, budget.result(), anomalies or [],
+        dict((riservice, result_of(future)) for riservice, future in ri_results.items()), trend_costs,
+        dict((plan_type, future.result()) for plan_type, future in sp_results.items())
+    )
+    anomaly_state = get_anomaly_state()
+    if anomaly_state is not None:
+        report.anomalies = anomaly_state.track(account, start_week, report.anomalies, anomalies_read)
+    return report
+
+
+def load_payer_budgets(budgets):
+
+    # without the payer budgets every account is asked for its own
+    try:
+        budgets.load(get_local_client('budgets'), local_account())
+    except ClientError as e:
+        logging.error('Budgets of the payer account not read: %s', e)
+
+
+def collect_accounts(accounts, start_week, end_week, month_start_date, current_year):
+
+    # accounts are fetched on a bounded pool but handed out in the given order,
+    # so the report comes out exactly as in a serial run
+    with ThreadPoolExecutor(max_workers=API_WORKERS) as api_pool, \
+            ThreadPoolExecutor(max_workers=ACCOUNT_WORKERS) as account_pool:
+        history = get_history()
+        trend = get_trend_history()
+        budgets = BudgetIndex()
+        payer_budgets = None
+        org_costs = None
+        org_trend = None
+        org_anomalies = None
+        if ANOMALY_QUERY_MODE in ('monitor', 'organization'):
+            # the split runs after the queries it waits for, which were queued on the pool before it
+            sources = fetch_org_anomalies(api_pool, list(accounts), start_week, end_week)
+            org_anomalies = api_pool.submit(split_anomalies, sources, list(accounts))
+        if COST_QUERY_MODE == 'organization':
+            # finops budgets kept in the payer account are read in one paginated call
+            payer_budgets = api_pool.submit(timed, 'Budget', None, load_payer_budgets, budgets)
+            # costs of every account come from the payer account, roles are only
+            # assumed for the budget, anomaly and RI calls
+            if history is not None:
+                org_costs = api_pool.submit(timed, 'OrgCostFetch', None, get_incremental_org_costs, history, get_local_client('ce'), list(accounts), start_week, end_week, month_start_date)
+            else:
+                org_costs = api_pool.submit(timed, 'OrgCostFetch', None, get_org_costs, get_local_client('ce'), list(accounts), start_week, end_week, month_start_date)
+            if trend is not None:
+                org_trend = api_pool.submit(timed, 'TrendFetch', None, get_org_trend_costs, trend, get_local_client('ce'), list(accounts), start_week)
+        # at most ACCOUNT_WORKERS * 2 accounts are in flight, the next one is submitted as one
+        # is handed out, so finished reports do not pile up behind a slow account
+        remaining = iter(list(accounts))
+        futures = deque()
+
+        def submit(account):
+            futures.append(account_pool.submit(collect_account, account, start_week, end_week, month_start_date, current_year, api_pool, budgets, payer_budgets, org_costs, history, trend, org_trend, org_anomalies))
+
+        for account in islice(remaining, ACCOUNT_WORKERS * 2):
+            submit(account)
+        try:
+            while futures:
+                report = futures.popleft().result()
+                for account in islice(remaining, 1):
+                    submit(account)
+                yield report
+        finally:
+            for future in futures:
+                future.cancel()
+            # the responses of the run are kept even when the delivery fails
+            cache = get_cache()
+            if cache is not None:
+                cache.commit()
+
+
+class ColumnWidths:
+
+    # longest value of each column, updated as rows are appended. The openpyxl names are
+    # passed in by the workbook, so no import runs per row
+    def __init__(self, cell_type, get_column_letter):
+        self.cell_type = cell_type
+        self.get_column_letter = get_column_letter
+        self.lengths = []
 
-ASSUME_ROLE = os.environ['ASSUME_ROLE']
+    def update(self, row):
+        for col_idx, value in enumerate(row):
+            if isinstance(value, self.cell_type):
+                value = value.value
+            length = len(str(value)) if value is not None else 0
+            if col_idx == len(self.lengths):
+                self.lengths.append(length)
+            elif length > self.lengths[col_idx]:
+                self.lengths[col_idx] = length
 
-SES_REGION = os.environ['SES_REGION']
+    def apply(self, ws):
+        for col_idx, length in enumerate(self.lengths, start=1):
+            if length:
+                ws.column_dimensions[self.get_column_letter(col_idx)].width = (length + 2) * 0.8
 
-SUBJECT = "[AWS COSTING]: AWS Costs from {} to {}"
+    def preset(self, ws, header):
+        # fixed widths for a write-only sheet, set before its first row is written
+        self.update(header)
+        self.lengths = [max(length, STREAMING_COLUMN_WIDTH) for length in self.lengths]
+        self.lengths += [STREAMING_COLUMN_WIDTH] * (STREAMING_COLUMNS - len(self.lengths))
+        self.apply(ws)
 
-CHARSET = 'UTF-8'
 
-SEND_FROM = os.environ['SEND_FROM']
+def copy_cell(ws, value, cell_type, cell_class):
 
-ri_services = ['Amazon Elastic Compute Cloud - Compute', 'Amazon Relational Database Service', 'Amazon Redshift', 'Amazon ElastiCache', 'Amazon Elasticsearch Service', 'Amazon OpenSearch Service']
+    if not isinstance(value, cell_type):
+        return value
+    cell = cell_class(ws, value=value.value)
+    if value.has_style:
+        cell.font = copy(value.font)
+    return cell
 
-recipients = [
-# add recepient emails to this list
-    ]
-    
-aws_accounts = {
-'123456789111':[{
-    'acc_name':'aws-account-name01',
-    'ano_arn':'arn:aws:ce::123456789111:anomalymonitor/84f93920-r8e90-333f-9320d-48wehr30',
-    'acc_owner':'account.owner@email.com'
-}],
-'123456789011':[{
-    'acc_name':'aws-account-name02',
-    'ano_arn':'arn:aws:ce::123456789011:anomalymonitor/84f93920-480dfr-292f-3020f-48wehr30',
-    'acc_owner':'account.owner@email.com'
-}]
+
+class ReportSheet:
+
+    # owner sheet that tracks column widths. In streaming mode every row is written as it
+    # is appended, the widths are fixed when the first row, usually the header, arrives.
+    # parent is the workbook, so Cell(ws, ...) and its fonts work as on a normal sheet.
+    # cell_type is the Cell class of the rows, cell_class the one their cells are copied to
+    def __init__(self, workbook, ws, cell_type, cell_class, get_column_letter):
+        self.parent = workbook
+        self.title = ws.title
+        self.ws = ws
+        self.cell_type = cell_type
+        self.cell_class = cell_class
+        self.widths = ColumnWidths(cell_type, get_column_letter)
+        self.started = False
+
+    def append(self, row):
+        if self.parent.write_only:
+            if not self.started:
+                self.widths.preset(self.ws, row)
+                self.started = True
+        else:
+            self.widths.update(row)
+        self.ws.append([copy_cell(self.ws, value, self.cell_type, self.cell_class) for value in row])
+
+
+class ReportWorkbook:
+
+    def __init__(self, owners, streaming=False):
+        from openpyxl import Workbook
+        from openpyxl.cell import Cell, WriteOnlyCell
+        from openpyxl.utils import get_column_letter
+        self.streaming = streaming
+        self.wb = Workbook(write_only=streaming)
+        cell_class = WriteOnlyCell if streaming else Cell
+        self.sheets = {}
+        for owner in owners:
+            self.sheets[owner] = ReportSheet(self.wb, self.wb.create_sheet(owner), Cell, cell_class, get_column_letter)
+        if not streaming:
+            #deleting unwanted initial sheet
+            del self.wb['Sheet']
+
+    def __getitem__(self, owner):
+        return self.sheets[owner]
+
+    def __iter__(self):
+        return iter(self.sheets.values())
+
+    def save(self, filename):
+        # filename can also be a binary file object
+        if not self.streaming:
+            for sheet in self:
+                # setting excel file column width
+                sheet.widths.apply(sheet.ws)
+        self.wb.save(filename)
+
+
+##### Cross account views, aggregated from the collected reports #####
+def numpy_module():
+
+    # numpy is optional, for example from a layer, the views are computed in plain Python without it
+    try:
+        import numpy
+        return numpy
+    except ImportError:
+        return None
+
+
+class CostTable:
+
+    # the service costs of every account of the run as integer cents, with the owner and
+    # service of each row stored as codes. The owner and organization views are summed and
+    # ranked in bulk from these rows, the cents keep the sums equal to adding the Decimals
+    GROUPS = ('owner', 'service')
+
+    def __init__(self):
+        self.keys = dict((group, {}) for group in self.GROUPS)
+        self.rows = dict((group, []) for group in self.GROUPS + ('cents',))
+
+    def code(self, group, key):
+        return self.keys[group].setdefault(key, len(self.keys[group]))
+
+    def add(self, report):
+        owner = self.code('owner', report.owner)
+        for cost in report.services:
+            self.rows['owner'].append(owner)
+            self.rows['service'].append(self.code('service', cost.service))
+            self.rows['cents'].append(int(cost.amount.scaleb(2)))
+
+    def ranked(self, group):
+
+        # cents of every code of the group as (code, cents) pairs, highest cost first, then by code
+        np = numpy_module()
+        if np is None:
+            sums = [0] * len(self.keys[group])
+            for code, cents in zip(self.rows[group], self.rows['cents']):
+                sums[code] += cents
+            return sorted(enumerate(sums), key=lambda item: (-item[1], item[0]))
+        # every code was added with at least one row, so the sums line up with the codes
+        totals = np.zeros(len(self.keys[group]), dtype=np.int64)
+        np.add.at(totals, np.asarray(self.rows[group], dtype=np.int64), np.asarray(self.rows['cents'], dtype=np.int64))
+        order = np.argsort(-totals, kind='stable')
+        return list(zip(order.tolist(), totals[order].tolist()))
+
+    def totals(self, group):
+
+        # total cost of every owner or service, highest first, ties in the order they were added
+        names = list(self.keys[group])
+        return [(names[code], cents_to_amount(cents)) for code, cents in self.ranked(group)]
+
+    def top(self, top=TOP_SERVICES):
+
+        # the most expensive services of the organization, ties keep the order they were first seen in
+        return self.totals('service')[:top]
+
+
+def cents_to_amount(cents):
+    return decimal.Decimal(int(cents)).scaleb(-2)
+
+
+##### Renderers, each reads the account reports in order #####
+RI_SHEET_TITLES = {
+    'Amazon Relational Database Service': 'Amazon RDS',
+    'Amazon ElastiCache': 'Amazon ElastiCache',
+    'Amazon OpenSearch Service': 'Amazon OpenSearch Service',
+    'Amazon Elastic Compute Cloud - Compute': 'Amazon EC2',
+    'Amazon Redshift': 'Amazon Redshift'
 }
 
+# sheet of the RI workbook that compares the options of the matrix mode
+RI_OPTIONS_SHEET = 'RI_Options'
 
-def get_client(instance_account_id: str, instance_region_id: str, resource_type: str):
+SAVINGS_PLANS_TITLES = {
+    'COMPUTE_SP': 'Compute Savings Plans',
+    'EC2_INSTANCE_SP': 'EC2 Instance Savings Plans'
+}
+
+
+def render_html(html, report):
+
+    html.write(OWNER_HEADING.format(report.owner))
+    trend = trend_enabled()
+    html.write(TREND_ACCOUNT_TABLE if trend else ACCOUNT_TABLE)
+    for index, cost in enumerate(report.top_services):
+        row = html_bold_row if index == 0 else html_row
+        if trend:
+            html.write(row(report.account, report.name, cost.service, str(cost.amount), *cost.trend_columns()))
+        else:
+            html.write(row(report.account, report.name, cost.service, str(cost.amount)))
+    if report.weekly_budget is not None:
+        html.write(SPACER_ROW)
+        if report.total_cost > report.weekly_budget:
+            html.write(WEEK_TOTAL_EXCEEDED_ROW.format(report.total_cost))
+        else:
+            html.write(WEEK_TOTAL_ROW.format(report.total_cost))
+    else:
+        html.write(WEEK_TOTAL_ROW.format(report.total_cost))
+    html.write(MONTH_TOTAL_ROW.format(report.month_cost))
+    html.write(TABLE_END)
+    if report.anomalies:
+        html.write(ANOMALY_HEADING.format(report.account, report.name))
+        tracking = anomaly_tracking()
+        html.write(TRACKED_ANOMALY_TABLE if tracking else ANOMALY_TABLE)
+        for anomaly in report.anomalies:
+            status = [anomaly.status or '-'] if tracking else []
+            html.write(html_row(anomaly.service, anomaly.start_date, anomaly.end_date, anomaly.region, anomaly.usage_type, str(anomaly.max_impact), str(anomaly.total_impact), *status))
+            # the other root causes follow on rows of their own, the impact is the anomaly's
+            for service, region, usage_type in anomaly.root_causes:
+                html.write(html_row(service, '', '', region, usage_type, '', '', *[''] * len(status)))
+        html.write(TABLE_END)
+    for riservice, recommendations in report.ri_recommendations.items():
+        if not recommendations:
+            continue
+        if riservice == 'Amazon Relational Database Service':
+            html.write(RDS_HEADING.format(riservice))
+        else:
+            html.write(RI_HEADING.format(riservice))
+        html.write(RI_TABLES[riservice])
+        for recommendation in recommendations:
+            html.write(html_row(*recommendation.columns()))
+        html.write(TABLE_END)
+    if report.savings_plans:
+        html.write(SAVINGS_PLANS_HEADING.format(report.account, report.name))
+        html.write(SAVINGS_PLANS_TABLE)
+        for recommendation in report.savings_plans:
+            html.write(html_row(*recommendation.columns()))
+        html.write(TABLE_END)
+    html.write(SEPARATOR)
+
+
+def render_summary(html, table):
+
+    # owner subtotals and the top services across every account, from the collected rows
+    html.write(SUMMARY_HEADING)
+    html.write(OWNER_SUMMARY_TABLE)
+    owners = table.totals('owner')
+    for owner, amount in owners:
+        html.write(html_row(owner, str(amount)))
+    html.write(SPACER_ROW)
+    html.write(ORG_TOTAL_ROW.format(sum((amount for owner, amount in owners), to_cents(0))))
+    html.write(TABLE_END)
+    html.write(SERVICE_SUMMARY_TABLE)
+    for index, (service, amount) in enumerate(table.top()):
+        row = html_bold_row if index == 0 else html_row
+        html.write(row(service, str(amount)))
+    html.write(TABLE_END)
+    html.write(SEPARATOR)
+
+
+def render_xlsx(wb, wb_ri, report):
 
-    # Go for STS to assume role for cross account
-    sts_connection = boto3.client('sts')
-    acct_b = sts_connection.assume_role(
-        RoleArn="arn:aws:iam::{}:role/{}".format(instance_account_id, ASSUME_ROLE),
-        RoleSessionName="cross_acct_access_for_lambda"
+    from openpyxl.cell import Cell
+    ws = wb[report.owner_name]
+    # the trend columns follow the cost, the anomaly rows leave them empty
+    trend = trend_enabled()
+    # so does the status of tracked anomalies, after the impact
+    tracking = anomaly_tracking()
+    for cost in report.top_services:
+        ws.append([report.account, report.name, cost.service, str(cost.amount)]
+                  + (list(cost.trend_columns()) if trend else [])
+                  + ['-', '-', '-', '-', '-', '-', '-']
+                  + (['-'] if tracking else []))
+    for anomaly in report.anomalies:
+        ws.append([
+            report.account,
+            report.name,
+            '-',
+            '-'
+        ] + (['-', '-', '-', '-'] if trend else []) + [
+            anomaly.service,
+            anomaly.start_date,
+            anomaly.end_date,
+            anomaly.region,
+            anomaly.usage_type,
+            str(anomaly.max_impact),
+            str(anomaly.total_impact)
+        ] + ([anomaly.status or '-'] if tracking else []))
+        for service, region, usage_type in anomaly.root_causes:
+            ws.append([report.account, report.name, '-', '-'] + (['-', '-', '-', '-'] if trend else []) + [service, '', '', region, usage_type, '', '']
+                      + ([''] if tracking else []))
+    ws = wb_ri[report.owner_name]
+    for riservice, recommendations in report.ri_recommendations.items():
+        if not recommendations:
+            continue
+        ws.append([])
+        ws.append([Cell(ws, value='{0} for account {1}'.format(RI_SHEET_TITLES[riservice], report.name))])
+        ws.append(RI_COLUMNS[riservice])
+        for recommendation in recommendations:
+            ws.append(list(recommendation.columns()))
+    if report.savings_plans:
+        ws.append([])
+        ws.append([Cell(ws, value='Savings Plans for account {0}'.format(report.name))])
+        ws.append(SAVINGS_PLANS_COLUMNS)
+        for recommendation in report.savings_plans:
+            ws.append(list(recommendation.columns()))
+    if report.ri_options:
+        ws = wb_ri[RI_OPTIONS_SHEET]
+        for options in report.ri_options:
+            for row in options.rows():
+                ws.append([report.account, report.name] + row)
+
+
+@dataclass(slots=True)
+class Attachment:
+    name: str
+    buffer: io.BytesIO
+    size: int
+
+
+def workbook_attachment(workbook, name):
+
+    # the workbook is saved to memory once, the S3 upload and the email read the same buffer
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    return Attachment(name, buffer, buffer.tell())
+
+
+def zip_attachments(attachments, name):
+
+    import zipfile
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for attachment in attachments:
+            archive.writestr(attachment.name, attachment.buffer.getbuffer())
+    return Attachment(name, buffer, buffer.tell())
+
+
+def upload_attachment(attachment, bucket, object_name=None):
+
+    if object_name is None:
+        object_name = attachment.name
+
+    s3_client = get_local_client('s3')
+    attachment.buffer.seek(0)
+    try:
+        s3_client.upload_fileobj(attachment.buffer, bucket, object_name)
+    except ClientError as e:
+        logging.error(e)
+        return False
+    return True
+
+
+def attachment_link(attachment, bucket):
+    return get_local_client('s3').generate_presigned_url(
+        'get_object',
+        Params={'Bucket': bucket, 'Key': attachment.name},
+        ExpiresIn=LINK_EXPIRY
     )
-    access_key = acct_b['Credentials']['AccessKeyId']
-    secret_key = acct_b['Credentials']['SecretAccessKey']
-    session_token = acct_b['Credentials']['SessionToken']
-     # create service client using the assumed role credentials
-    return boto3.client(
-        resource_type,
-        aws_access_key_id=access_key,
-        aws_secret_access_key=secret_key,
-        aws_session_token=session_token,
-        region_name=instance_region_id
+
+
+##### Columnar export of the report records #####
+# columns and their types of each dataset, week and account are partition keys in the path
+EXPORT_COLUMNS = {
+    'service_costs': [
+        ('rank', 'int'), ('service', 'string'), ('amount', 'decimal'), ('week_total', 'decimal'),
+        ('month_to_date', 'decimal'), ('weekly_budget', 'decimal'), ('account_name', 'string'), ('owner', 'string')
+    ],
+    'anomalies': [
+        ('service', 'string'), ('start_date', 'date'), ('end_date', 'date'), ('region', 'string'),
+        ('usage_type', 'string'), ('max_impact', 'float'), ('total_impact', 'float')
+    ],
+    'ri_recommendations': [
+        ('ri_service', 'string'), ('action', 'string'), ('instance_type', 'string'), ('details', 'string'),
+        ('upfront_cost', 'decimal'), ('monthly_savings', 'decimal')
+    ]
+}
+
+
+def export_format():
+
+    if EXPORT_FORMAT in ('auto', 'parquet'):
+        try:
+            import pyarrow.parquet
+            return 'parquet'
+        except ImportError:
+            if EXPORT_FORMAT == 'parquet':
+                logging.error('pyarrow is not installed, exporting CSV instead of Parquet')
+    return 'csv'
+
+
+def export_rows(report):
+
+    # every service of the week, ranked by cost, with the totals of the account on every row
+    service_costs = [
+        (rank, cost.service, cost.amount, to_cents(report.total_cost), report.month_cost, report.weekly_budget, report.name, report.owner)
+        for rank, cost in enumerate(report.services, start=1)
+    ]
+    anomalies = [
+        (anomaly.service, date.fromisoformat(anomaly.start_date), date.fromisoformat(anomaly.end_date),
+         anomaly.region, anomaly.usage_type, float(anomaly.max_impact), float(anomaly.total_impact))
+        for anomaly in report.anomalies
+    ]
+    ri_recommendations = []
+    for riservice, recommendations in report.ri_recommendations.items():
+        # the detail columns differ per service, they are kept as name=value pairs
+        names = RI_COLUMNS[riservice][2:-2]
+        for recommendation in recommendations:
+            details = '; '.join('{0}={1}'.format(name, value) for name, value in zip(names, recommendation.details))
+            ri_recommendations.append((riservice, recommendation.action, recommendation.instance_type, details,
+                                       recommendation.upfront_cost, recommendation.monthly_savings))
+    # Savings Plans share the dataset, with the plan as the service and the instance family as the type
+    for recommendation in report.savings_plans:
+        action = recommendation.columns()[0]
+        details = 'Region={0}; Hourly Commitment={1}'.format(recommendation.region, recommendation.hourly_commitment)
+        ri_recommendations.append((SAVINGS_PLANS_TITLES[recommendation.plan_type], action, recommendation.instance_family, details,
+                                   recommendation.upfront_cost, recommendation.monthly_savings))
+    return {'service_costs': service_costs, 'anomalies': anomalies, 'ri_recommendations': ri_recommendations}
+
+
+def parquet_buffer(columns, rows):
+
+    import pyarrow
+    import pyarrow.parquet
+    types = {
+        'string': pyarrow.string(),
+        'decimal': pyarrow.decimal128(18, 2),
+        'float': pyarrow.float64(),
+        'int': pyarrow.int32(),
+        'date': pyarrow.date32()
+    }
+    schema = pyarrow.schema([(name, types[kind]) for name, kind in columns])
+    values = list(zip(*rows))
+    table = pyarrow.Table.from_arrays(
+        [pyarrow.array(values[index], type=field.type) for index, field in enumerate(schema)],
+        schema=schema
     )
+    buffer = io.BytesIO()
+    pyarrow.parquet.write_table(table, buffer, compression='snappy')
+    return buffer
 
-    
-def get_week_days(year, week):
 
-    year_start = date(year, 1, 1)
+def csv_buffer(columns, rows):
 
-    week_start = year_start + timedelta(days=-year_start.isoweekday(), weeks=week)
-    week_end_title = week_start + timedelta(days=6)
-    week_end = week_start + timedelta(days=7)
-    month_start = week_start.replace(day=1)
-    return week_start, week_end, week_end_title, month_start
+    import csv
+    text = io.StringIO()
+    writer = csv.writer(text)
+    writer.writerow([name for name, kind in columns])
+    for row in rows:
+        writer.writerow(['' if value is None else value for value in row])
+    return io.BytesIO(text.getvalue().encode('utf-8'))
+
+
+def export_report(report, start_week, file_format):
+
+    with metrics.timer('Export'):
+        for dataset, rows in export_rows(report).items():
+            if not rows:
+                continue
+            if file_format == 'parquet':
+                buffer = parquet_buffer(EXPORT_COLUMNS[dataset], rows)
+            else:
+                buffer = csv_buffer(EXPORT_COLUMNS[dataset], rows)
+            key = '{0}/{1}/week={2}/account={3}/{1}.{4}'.format(EXPORT_PREFIX, dataset, start_week, report.account, file_format)
+            size = buffer.seek(0, io.SEEK_END)
+            metrics.add('ExportBytes', size, unit='Bytes')
+            upload_attachment(Attachment(key, buffer, size), 'aws-ce-reports')
+
+
+def export_reports(reports, start_week):
+
+    # hands the reports on unchanged while they are exported on a pool, a failed
+    # export is logged and does not hold back the email
+    if EXPORT_FORMAT == 'none':
+        yield from reports
+        return
+    file_format = export_format()
+    with ThreadPoolExecutor(max_workers=API_WORKERS) as export_pool:
+        exports = []
+        for report in reports:
+            exports.append((report.account, export_pool.submit(export_report, report, start_week, file_format)))
+            yield report
+        for account, future in exports:
+            try:
+                future.result()
+            except Exception as e:
+                logging.error('Export of account %s failed: %s', account, e)
 
 
 def upload_file(file_name, bucket, object_name=None):
@@ -83,7 +2417,7 @@ def upload_file(file_name, bucket, object_name=None):
     if object_name is None:
         object_name = os.path.basename(file_name)
 
-    s3_client = boto3.client('s3')
+    s3_client = get_local_client('s3')
     try:
         response = s3_client.upload_file(file_name, bucket, object_name)
     except ClientError as e:
@@ -91,1013 +2425,465 @@ def upload_file(file_name, bucket, object_name=None):
         return False
     return True
 
-def send_email_with_attachment(start_week, end_week_title, bodyhtml, file_name, ses_region):
+def send_email_with_attachment(start_week, end_week_title, html, attachments, ses_region, destinations=None):
+    from email.mime.application import MIMEApplication
+    from email.mime.multipart import MIMEMultipart
+    if destinations is None:
+        destinations = recipients
     msg = MIMEMultipart()
     msg["Subject"] = SUBJECT.format(start_week, end_week_title)
     msg["From"] = SEND_FROM
     # convert recepients list to string
-    msg["To"] = ", ".join(recipients)
+    msg["To"] = ", ".join(destinations)
     
     # Set message body
-    body = MIMEText(bodyhtml.format(start_week, end_week_title), "html")
-    msg.attach(body)
+    msg.attach(html.mime_part())
 
-    for filename in file_name:
+    for attachment in attachments:
 
-        with open(filename, "rb") as attachment:
-            part = MIMEApplication(attachment.read())
-            part.add_header("Content-Disposition",
-                            "attachment",
-                            filename=os.path.basename(filename))
+        # base64 is encoded straight from the buffer, without a copy of the workbook
+        part = MIMEApplication(attachment.buffer.getbuffer())
+        part.add_header("Content-Disposition",
+                        "attachment",
+                        filename=attachment.name)
         msg.attach(part)
-    # Convert message to string and send
-    ses_client = boto3.client("ses", region_name=ses_region)
+    # Convert message to bytes and send
+    raw_message = msg.as_bytes()
+    metrics.add('EmailBytes', len(raw_message), unit='Bytes')
+    ses_client = get_local_client('ses', ses_region)
     response = ses_client.send_raw_email(
         Source=SEND_FROM,
-        Destinations=recipients,
-        RawMessage={"Data": msg.as_string()}
+        Destinations=destinations,
+        RawMessage={"Data": raw_message}
     )
-    print('Email sent to ', recipients, ' Message ID: ', response['MessageId'])
+    print('Email sent to ', destinations, ' Message ID: ', response['MessageId'])
 
 
 
-def lambda_handler(event, context):
-    
-    BODY_HTML = """<html>
-        <head></head>
-        <body>
-        Hi,<br>
-        As part of Cloud Governance, we are sending weekly AWS costing report along with Cost Anomalies and RI recommendations for each of the AWS accounts. The report is generated using the amortized costs of the account. Respective account owners can find any cost anomalies and recommendations of the accounts. There are two excel files attached for the top 10 spends and RI recommendations for each of the AWS accounts.<br>
-        <br>The 'Total cost for all services this week' will be yellow highlighted if the allocated budget is exceeded for the week.<br>
-        <br>This Report will shared once every week, please let us know if any of the recipients needed to be changed or added to this chain. 
-        <br>
-        <br>
-        <h4>AWS costs for the period of {} to {}</h4>
-        <h4>######################################</h4>
-        <div><table style="width:100%">"""
-    
-    local_client = boto3.client('ce')
+##### Shards, partial runs over a part of the accounts #####
+def get_shard(event):
 
+    if not isinstance(event, dict):
+        return None
+    # an empty accounts list still makes a shard, an empty one, instead of a full report
+    if 'accounts' in event:
+        if not isinstance(event['accounts'], list):
+            raise ValueError('accounts must be a list of account ids, got {0}'.format(event['accounts']))
+        unknown = [account for account in event['accounts'] if account not in aws_accounts]
+        if unknown:
+            print('Accounts not in aws_accounts are skipped: ', unknown)
+        # report order is the order of aws_accounts, whatever the order in the event
+        accounts = [account for account in aws_accounts if account in event['accounts']]
+        return 'accounts-' + hashlib.sha256(','.join(accounts).encode()).hexdigest()[:16], accounts
+    # a partial spec, like shards without shard, fails instead of sending the full report
+    if 'shard' in event or 'shards' in event:
+        try:
+            index = int(event['shard'])
+            count = int(event['shards'])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError('A shard event needs integer shard and shards keys, got {0}'.format(event))
+        if count < 1:
+            raise ValueError('shards must be at least 1, got {0}'.format(count))
+        if not 0 <= index < count:
+            # an index past the shard count would quietly collect no accounts
+            raise ValueError('shard must be from 0 to {0} for {1} shards, got {2}'.format(count - 1, count, index))
+        return 'shard-{0:04d}-of-{1:04d}'.format(index, count), list(aws_accounts)[index::count]
+    return None
+
+
+def report_to_dict(report):
+    return asdict(report)
+
+
+def report_from_dict(data):
+
+    return AccountReport(
+        account=data['account'],
+        name=data['name'],
+        owner=data['owner'],
+        services=[
+            ServiceCost(
+                cost['service'],
+                decimal.Decimal(cost['amount']),
+                decimal.Decimal(cost['previous']) if cost.get('previous') is not None else None,
+                decimal.Decimal(cost['average']) if cost.get('average') is not None else None
+            )
+            for cost in data['services']
+        ],
+        total_cost=decimal.Decimal(data['total_cost']),
+        month_cost=decimal.Decimal(data['month_cost']),
+        weekly_budget=decimal.Decimal(data['weekly_budget']) if data['weekly_budget'] is not None else None,
+        anomalies=[
+            Anomaly(**dict(anomaly, root_causes=[tuple(cause) for cause in anomaly.get('root_causes', [])]))
+            for anomaly in data['anomalies']
+        ],
+        ri_recommendations=dict(
+            (riservice, [
+                RIRecommendation(
+                    recommendation['action'],
+                    recommendation['instance_type'],
+                    tuple(recommendation['details']),
+                    decimal.Decimal(recommendation['upfront_cost']),
+                    decimal.Decimal(recommendation['monthly_savings'])
+                )
+                for recommendation in recommendations
+            ])
+            for riservice, recommendations in data['ri_recommendations'].items()
+        ),
+        savings_plans=[
+            SavingsPlanRecommendation(
+                recommendation['plan_type'],
+                recommendation['instance_family'],
+                recommendation['region'],
+                decimal.Decimal(recommendation['hourly_commitment']),
+                decimal.Decimal(recommendation['upfront_cost']),
+                decimal.Decimal(recommendation['monthly_savings'])
+            )
+            for recommendation in data.get('savings_plans', [])
+        ],
+        ri_options=[
+            RIOptions(
+                options['riservice'],
+                options['instance_type'],
+                tuple(options['details']),
+                [decimal.Decimal(savings) if savings is not None else None for savings in options['savings']],
+                options['best']
+            )
+            for options in data.get('ri_options', [])
+        ]
+    )
+
+
+def shard_run(event):
+
+    # shards and the merge of one run share a run id, so a merge never reads the shards
+    # another run of the same week left behind
+    run = str(event.get('run', '')) if isinstance(event, dict) else ''
+    if '/' in run:
+        raise ValueError('The run id can not contain /, got {0}'.format(run))
+    return run
+
+
+def shard_location(start_week, run, name=''):
+    return '/'.join([SHARD_PATH.rstrip('/'), str(start_week)] + ([run] if run else []) + [name])
+
+
+def write_shard(shard_name, start_week, run, reports):
+
+    reports = [report_to_dict(report) for report in reports]
+    # decimals are written as strings so amounts keep their exact digits
+    body = json.dumps({'week': str(start_week), 'reports': reports}, default=str)
+    location = shard_location(start_week, run, shard_name + '.json')
+    if location.startswith('s3://'):
+        bucket, key = location[len('s3://'):].split('/', 1)
+        get_local_client('s3').put_object(Bucket=bucket, Key=key, Body=body.encode('utf-8'))
+    else:
+        os.makedirs(os.path.dirname(location), exist_ok=True)
+        with open(location, 'w') as f:
+            f.write(body)
+    metrics.add('ShardBytes', len(body), unit='Bytes')
+    print('Shard written to ', location, ' accounts: ', len(reports))
+
+
+def read_shards(start_week, run):
+
+    # returns the reports by account and the shard files they were read from
+    location = shard_location(start_week, run)
+    bodies = []
+    names = []
+    if location.startswith('s3://'):
+        bucket, prefix = location[len('s3://'):].split('/', 1)
+        s3_client = get_local_client('s3')
+        # the delimiter leaves out the shards of named runs below the week
+        for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix, Delimiter='/'):
+            for item in page.get('Contents', []):
+                if item['Key'].endswith('.json'):
+                    bodies.append(s3_client.get_object(Bucket=bucket, Key=item['Key'])['Body'].read())
+                    names.append(item['Key'][len(prefix):])
+    elif os.path.isdir(location):
+        for name in sorted(os.listdir(location)):
+            if name.endswith('.json'):
+                with open(os.path.join(location, name)) as f:
+                    bodies.append(f.read())
+                names.append(name)
+    reports = {}
+    for body in bodies:
+        for data in json.loads(body)['reports']:
+            reports[data['account']] = report_from_dict(data)
+    print('Shards read from ', location, ' shards: ', len(bodies), ' accounts: ', len(reports))
+    return reports, names
+
+
+def delete_shards(start_week, run, names):
+
+    location = shard_location(start_week, run)
+    if location.startswith('s3://'):
+        bucket, prefix = location[len('s3://'):].split('/', 1)
+        s3_client = get_local_client('s3')
+        # delete_objects takes up to 1000 keys a request
+        for start in range(0, len(names), 1000):
+            s3_client.delete_objects(Bucket=bucket, Delete={
+                'Objects': [{'Key': prefix + name} for name in names[start:start + 1000]], 'Quiet': True
+            })
+    else:
+        for name in names:
+            os.remove(os.path.join(location, name))
+    print('Shards deleted from ', location, ' shards: ', len(names))
+
+
+def report_week():
 
     # Finding start and end date of last week
     current_date = datetime.now()
     current_year = current_date.year
     last_week = int((current_date.strftime("%W")))-1
     week_days = get_week_days(current_year, last_week)
+    return week_days + (current_year,)
 
-    start_week = week_days[0] 
-    end_week = week_days[1]
-    end_week_title = week_days[2]
-    month_start_date = week_days[3]
-    
-    
-    accounts = aws_accounts.keys()
-    
-    # create xlsx file attachments
-    wb = Workbook()
-    wb_ri = Workbook()
-    bold_font = Font(bold=True)
-    xlheaders = ['Account_ID', 'Account_Name', 'Service_Name', 'AWS_Cost','Anomaly_Service', 'Anomaly_StartDate', 'Anomaly_EndDate', 'Region', 'Usage_Type','Max_Anomaly_Impact','Total_Anomaly_Impact']
-    worksheet_owner = set()
+
+def report_owners():
+
+    worksheet_owner = []
+    # last account of each owner, the owner sheets can be written once it is rendered
+    last_account = {}
     #getting and creating sheet names from the dictionary
-    for i in aws_accounts.values():
+    for account, i in aws_accounts.items():
         for subdict in i:
             owner_email = subdict['acc_owner']
             owner_name = owner_email.split('@')[0]
             if owner_name not in worksheet_owner:
-                worksheet_owner.add(owner_name)
-                wb.create_sheet(owner_name)
-                wb_ri.create_sheet(owner_name)
+                worksheet_owner.append(owner_name)
+            last_account[owner_name] = account
+    return worksheet_owner, last_account
 
-    
 
-    #deleting unwanted initial sheet
-    del wb['Sheet']
-    del wb_ri['Sheet']
+def new_workbooks(worksheet_owner):
+
+    from openpyxl.cell import Cell
+    from openpyxl.styles import Font
+    # create xlsx file attachments
+    bold_font = Font(bold=True)
+    xlheaders = ['Account_ID', 'Account_Name', 'Service_Name', 'AWS_Cost','Anomaly_Service', 'Anomaly_StartDate', 'Anomaly_EndDate', 'Region', 'Usage_Type','Max_Anomaly_Impact','Total_Anomaly_Impact']
+    if trend_enabled():
+        xlheaders[4:4] = ['Previous_Week_Cost', 'Cost_Change', 'Cost_Change_Percent', 'Trailing_{}_Week_Average'.format(TREND_WEEKS)]
+    if anomaly_tracking():
+        xlheaders.append('Anomaly_Status')
+    wb = ReportWorkbook(worksheet_owner, EXCEL_MODE == 'streaming')
+    if RI_RECOMMENDATION_MODE == 'matrix':
+        # the comparison sheet follows the owner sheets, it is written when the workbook is saved
+        wb_ri = ReportWorkbook(worksheet_owner + [RI_OPTIONS_SHEET], EXCEL_MODE == 'streaming')
+        header_cells = []
+        for header in ['Account_ID', 'Account_Name', 'Service', 'Instance_Type', 'Details', 'Lookback'] + [
+                '{0} {1}'.format(RI_OPTION_LABELS[term], RI_OPTION_LABELS[payment]) for term in RI_TERMS for payment in RI_PAYMENT_OPTIONS] + ['Best_Option']:
+            header_cell = Cell(wb_ri[RI_OPTIONS_SHEET], value=header)
+            header_cell.font = bold_font
+            header_cells.append(header_cell)
+        wb_ri[RI_OPTIONS_SHEET].append(header_cells)
+    else:
+        wb_ri = ReportWorkbook(worksheet_owner, EXCEL_MODE == 'streaming')
 
     # create column headers for each sheet
     for sheet in wb:
-        sheet.append(xlheaders)
-        for col in range(1, 12):
-            sheet[get_column_letter(col) + '1'].font = Font(bold=True)
-    
+        header_cells = []
+        for header in xlheaders:
+            header_cell = Cell(sheet, value=header)
+            header_cell.font = bold_font
+            header_cells.append(header_cell)
+        sheet.append(header_cells)
+    return wb, wb_ri
 
-    for account in accounts:
-        db = {}
-        total_cost = 0
-        if account == '123456789111':
-            ##### Getting Cost and Usage data #####
-            results = local_client.get_cost_and_usage(
-                TimePeriod={
-                    'Start': str(start_week),
-                    'End': str(end_week)
-                },
-                Granularity='MONTHLY',
-                Metrics=[
-                    'AmortizedCost',
-                ],
-                GroupBy=[
-                    {
-                        'Type': 'DIMENSION',
-                        'Key': 'SERVICE'
-                    },
-                ],
-            )
-            ##### Getting up to date cost
-            month_results = local_client.get_cost_and_usage(
-                TimePeriod={
-                    'Start': str(month_start_date),
-                    'End': str(end_week)
-                },
-                Granularity='MONTHLY',
-                Metrics=[
-                    'AmortizedCost',
-                ]
-            )
-            if month_results.get('ResultsByTime'):
-                uptodate_cost = month_results.get('ResultsByTime')[0]['Total']['AmortizedCost']['Amount']
-                decimalMonth = decimal.Decimal(uptodate_cost)
-                roundedMonth = decimalMonth.quantize(decimal.Decimal('0.00'))
-            #print ("This is the results: {}".format(results))
-            services = results.get('ResultsByTime')[0]['Groups']
-            for service in services:
-                service_name = service.get('Keys')[0]
-                amount = service.get('Metrics')['AmortizedCost']['Amount']
-                decimalAmount = decimal.Decimal(amount)
-                roundedAmount = decimalAmount.quantize(decimal.Decimal('0.00'))
-                db[service_name] = roundedAmount
-                total_cost = total_cost + roundedAmount
-                #BODY_HTML = BODY_HTML + "<tr><td>"+account+"</td><td>"+service_name+"</td><td>"+str(roundedAmount)+"</td></tr>"
-            sorted_dict = sorted(db.items(), key=lambda x:x[1], reverse=True)
-            sorted_dict = dict(sorted_dict)
-            index = 0
-            n = 1
-            #print("Sorted Dictionary: {}".format(sorted_dict))
-            BODY_HTML = BODY_HTML + "<h4>Account Owner: {}</h4>".format(aws_accounts[account][0]['acc_owner'])
-            BODY_HTML = BODY_HTML + """<div><table style="width:100%">
-            <thead><tr><td><b style="font-family:'Open Sans';font-size:13px">Account No</b></td><td><b style="font-family:'Open Sans';font-size:13px">Account Name</b></td><td><b style="font-family:'Open Sans';font-size:13px">Service Name</b></td><td><b style="font-family:'Open Sans';font-size:13px">AWS Cost</b></td></tr></thead>
-            <tbody>"""
-            for i in sorted_dict:
-                index += 1
-                if n == 1:
-                    BODY_HTML = BODY_HTML + "<tr><td style=font-weight:bold>"+account+"</td><td style=font-weight:bold>"+aws_accounts[account][0]['acc_name']+"</td><td style=font-weight:bold>"+i+"</td><td style=font-weight:bold>"+str(sorted_dict[i])+"</td></tr>"
-                    n += 1
-                    #writing to excel
-                    owner_name = aws_accounts[account][0]['acc_owner'].split('@')[0]
-                    ws = wb[owner_name]
-                    ws.append([
-                        account,
-                        aws_accounts[account][0]['acc_name'],
-                        i,
-                        str(sorted_dict[i]),
-                        '-',
-                        '-',
-                        '-',
-                        '-',
-                        '-',
-                        '-',
-                        '-'
-                    ])
-                else:
-                    BODY_HTML = BODY_HTML + "<tr><td>"+account+"</td><td>"+aws_accounts[account][0]['acc_name']+"</td><td>"+i+"</td><td>"+str(sorted_dict[i])+"</td></tr>"
-                    #writing to excel
-                    owner_name = aws_accounts[account][0]['acc_owner'].split('@')[0]
-                    ws = wb[owner_name]
-                    ws.append([
-                        account,
-                        aws_accounts[account][0]['acc_name'],
-                        i,
-                        str(sorted_dict[i]),
-                        '-',
-                        '-',
-                        '-',
-                        '-',
-                        '-',
-                        '-',
-                        '-'
-                    ])                        
-                    if index > 9:
-                        break
-                    
-            ##### Getting monthly budget limit #####
-            budget_client = boto3.client('budgets')
-            budget_name = 'finops-ACCOUNT_' + account + '_MONTHLY_' + str(current_year)
-            try:
-                budget_response = budget_client.describe_budget(
-                    AccountId = account,
-                    BudgetName = budget_name
-                    )
-                if budget_response.get('Budget'):
-                    budgeted_amount = budget_response['Budget']['BudgetLimit'].get('Amount')
-                    weekly_budget = decimal.Decimal(budgeted_amount) / 4
-                    weekly_budget_rounded = weekly_budget.quantize(decimal.Decimal('0.00'))
-                    if total_cost > weekly_budget_rounded:
-                        BODY_HTML = BODY_HTML + "<tr height = 20px></tr>"
-                        BODY_HTML = BODY_HTML + "<tr colspan=2><td><span style='font-weight:bold;background-color: yellow'>"+"[!!Weekly budget limit exceeded!!] Total cost for all services this week == ${}".format(total_cost)+"</span></td>"
-                    else:
-                        BODY_HTML = BODY_HTML + "<tr height = 20px></tr>"
-                        BODY_HTML = BODY_HTML + "<tr colspan=2><td><span style=font-weight:bold>"+"Total cost for all services this week == ${}".format(total_cost)+"</span></td>"
-                
-            except ClientError:
-                BODY_HTML = BODY_HTML + "<tr colspan=2><td><span style=font-weight:bold>"+"Total cost for all services this week == ${}".format(total_cost)+"</span></td>"
-            BODY_HTML = BODY_HTML + "<tr colspan=2><td><span style=font-weight:bold>"+"Overall spend for the account in this month == ${}".format(roundedMonth)+"</span></td>"
-            BODY_HTML = BODY_HTML + "<tr height = 20px></tr>"
-            BODY_HTML = BODY_HTML + "</tbody></table></div>"
-            ##### Getting Anomaly data #####
-            ano_results = local_client.get_anomalies(
-                DateInterval={
-                    'StartDate': str(start_week),
-                    'EndDate': str(end_week)
-                },
-                MonitorArn = aws_accounts[account][0]['ano_arn']
-            )
-            if ano_results['Anomalies']:
-                BODY_HTML = BODY_HTML + "<h4>Anomaly Details for the account {0} ({1}):</h4>".format(account, aws_accounts[account][0]['acc_name'])
-                BODY_HTML = BODY_HTML + """<div><table style="width:100%">
-                <thead><tr><td><b style="font-family:'Open Sans';font-size:13px">Service</b></td><td><b style="font-family:'Open Sans';font-size:13px">Start Date</b></td><td><b style="font-family:'Open Sans';font-size:13px">End Date</b></td><td><b style="font-family:'Open Sans';font-size:13px">Region</b></td><td><b style="font-family:'Open Sans';font-size:13px">UsageType</b></td><td><b style="font-family:'Open Sans';font-size:13px">Max Impact</b></td><td><b style="font-family:'Open Sans';font-size:13px">Total Impact</b></td></tr></thead>
-                <tbody>"""
-                details = ano_results['Anomalies']
-                #print("Details: {}".format(details))
-                maximpact = {}
-                index = 0
-                for element in details:
-                    maximpact[index] = element['Impact']['MaxImpact']
-                    index += 1
-                #print("MAx impact: {}".format(maximpact))
-                sorted_max = sorted(maximpact.items(), key=lambda x:x[1], reverse=True)
-                sorted_max = dict(sorted_max)
-                #print("Sorted maximpact: {}".format(sorted_max))
-                #print("Sortex max: {}".format(sorted_max.keys()))
-                for i in sorted_max.keys():
-                    detail = details[i]
-                    #print("Detail: {}".format(detail))
-                    ano_startdate = ((detail['AnomalyStartDate']).split("T"))[0]
-                    ano_enddate = ((detail['AnomalyEndDate']).split("T"))[0]
-                    if detail['RootCauses'][0].get('Region'):
-                        region = detail['RootCauses'][0]['Region']
-                    else:
-                        region = '-'
-                    if detail['RootCauses'][0].get('UsageType'):
-                        usage_type = detail['RootCauses'][0]['UsageType']
-                    else:
-                        usage_type = '-'
-                    BODY_HTML = BODY_HTML + "<tr><td>"+detail['RootCauses'][0]['Service']+"</td><td>"+ano_startdate+"</td><td>"+ano_enddate+"</td><td>"+region+"</td><td>"+usage_type+"</td><td>"+str(detail['Impact']['MaxImpact'])+"</td><td>"+str(detail['Impact']['TotalImpact'])+"</td></tr>"
-                    #writing to excel
-                    owner_name = aws_accounts[account][0]['acc_owner'].split('@')[0]
-                    ws = wb[owner_name]
-                    ws.append([
-                        account,
-                        aws_accounts[account][0]['acc_name'],
-                        '-',
-                        '-',
-                        detail['RootCauses'][0]['Service'],
-                        ano_startdate,
-                        ano_enddate,
-                        region,
-                        usage_type,
-                        str(detail['Impact']['MaxImpact']),
-                        str(detail['Impact']['TotalImpact'])
-                    ])                                        
-                BODY_HTML = BODY_HTML + "<tr height = 20px></tr>"
-                BODY_HTML = BODY_HTML + "</tbody></table></div>"
-                
-            ##### Getting RI recommendations #####
-            for riservice in ri_services:
-                ri_results = local_client.get_reservation_purchase_recommendation(
-                    AccountId = account,
-                    Service = riservice,
-                    TermInYears = 'ONE_YEAR',
-                    LookbackPeriodInDays = 'THIRTY_DAYS',
-                    PaymentOption = 'ALL_UPFRONT'
-                )
-                
-                if ri_results.get('Recommendations'):
-                    #BODY_HTML = BODY_HTML + "<h4>RI Recommendations for the account {0} ({1}):</h4>".format(account, aws_accounts[account][0]['acc_name'])
-                    
-                    if riservice == 'Amazon Relational Database Service':
-                        BODY_HTML = BODY_HTML + "<h4>RI Recommendations for {0} (RDS):</h4>".format(riservice)
-                        BODY_HTML = BODY_HTML + """<div><table style="width:100%">
-                        <thead><tr><td><b style="font-family:'Open Sans';font-size:13px">Action</b></td><td><b style="font-family:'Open Sans';font-size:13px">Instance Type</b></td><td><b style="font-family:'Open Sans';font-size:13px">Region</b></td><td><b style="font-family:'Open Sans';font-size:13px">Database</b></td><td><b style="font-family:'Open Sans';font-size:13px">License</b></td><td><b style="font-family:'Open Sans';font-size:13px">Current Generation</b></td><td><b style="font-family:'Open Sans';font-size:13px">Upfront Cost</b></td><td><b style="font-family:'Open Sans';font-size:13px">Estimated Monthly Savings</b></td></tr></thead>
-                        <tbody>"""                        
-                        ri_details = ri_results['Recommendations'][0]['RecommendationDetails']
-                        maximpact = {}
-                        index = 0
-                        for ri in ri_details:
-                            maximpact[index] = decimal.Decimal(ri['EstimatedMonthlySavingsAmount'])
-                            index += 1
-                        sort_max = sorted(maximpact.items(), key=lambda x:x[1], reverse=True)
-                        sort_max = dict(sort_max)
-
-                        # writing to excel
-                        owner_name = aws_accounts[account][0]['acc_owner'].split('@')[0]
-                        ws = wb_ri[owner_name]
-                        ws.append([])
-                        bold_cell = Cell(ws, value='Amazon RDS for account {}'.format(aws_accounts[account][0]['acc_name']))
-                        ws.append([bold_cell])
-                        ws.append(['Action', 'Instance Type', 'Region', 'Database', 'License', 'Current Generation', 'Upfront Cost', 'Estimated Monthly Savings'])
-
-                        for i in sort_max.keys():
-                            detail = ri_details[i]
-                            action = "Buy {0} {1}".format(detail['RecommendedNumberOfInstancesToPurchase'],detail['InstanceDetails']['RDSInstanceDetails']['InstanceType'])
-                            instancetype = detail['InstanceDetails']['RDSInstanceDetails']['InstanceType']
-                            rgn = detail['InstanceDetails']['RDSInstanceDetails']['Region']
-                            database = detail['InstanceDetails']['RDSInstanceDetails']['DatabaseEngine']
-                            licen = detail['InstanceDetails']['RDSInstanceDetails']['LicenseModel']
-                            current_gen = str(detail['InstanceDetails']['RDSInstanceDetails']['CurrentGeneration'])
-                            upcost = decimal.Decimal(detail['UpfrontCost'])
-                            upcost_rounded = str(upcost.quantize(decimal.Decimal('0.00')))
-                            est_saving = decimal.Decimal(detail['EstimatedMonthlySavingsAmount'])
-                            est_sav_rounded = str(est_saving.quantize(decimal.Decimal('0.00')))
-                            BODY_HTML = BODY_HTML + "<tr><td>"+action+"</td><td>"+instancetype+"</td><td>"+rgn+"</td><td>"+database+"</td><td>"+licen+"</td><td>"+current_gen+"</td><td>"+upcost_rounded+"</td><td>"+est_sav_rounded+"</td></tr>"
-                            # writing to excel
-                            ws.append([
-                                action,
-                                instancetype,
-                                rgn,
-                                database,
-                                licen,
-                                current_gen,
-                                upcost_rounded,
-                                est_sav_rounded
-                                ])
-                            
-
-                        BODY_HTML = BODY_HTML + "<tr height = 20px></tr>"
-                        BODY_HTML = BODY_HTML + "</tbody></table></div>"
-                    
-                    elif riservice == 'Amazon ElastiCache':
-                        BODY_HTML = BODY_HTML + "<h4>RI Recommendations for {0}:</h4>".format(riservice)
-                        BODY_HTML = BODY_HTML + """<div><table style="width:100%">
-                        <thead><tr><td><b style="font-family:'Open Sans';font-size:13px">Action</b></td><td><b style="font-family:'Open Sans';font-size:13px">Instance Type</b></td><td><b style="font-family:'Open Sans';font-size:13px">Region</b></td><td><b style="font-family:'Open Sans';font-size:13px">Cache Engine</b></td><td><b style="font-family:'Open Sans';font-size:13px">Current Generation</b></td><td><b style="font-family:'Open Sans';font-size:13px">Upfront Cost</b></td><td><b style="font-family:'Open Sans';font-size:13px">Estimated Monthly Savings</b></td></tr></thead>
-                        <tbody>"""
-                        ri_details = ri_results['Recommendations'][0]['RecommendationDetails']
-                        max_impact = {}
-                        index = 0
-                        
-                        for ri in ri_details:
-                            max_impact[index] = decimal.Decimal(ri['EstimatedMonthlySavingsAmount'])
-                            index += 1
-                        sort_max = sorted(max_impact.items(), key=lambda x:x[1], reverse=True)
-                        sort_max = dict(sort_max)
-
-                        # writing to excel
-                        owner_name = aws_accounts[account][0]['acc_owner'].split('@')[0]
-                        ws = wb_ri[owner_name]
-                        ws.append([])
-                        bold_cell = Cell(ws, value='Amazon ElastiCache for account {}'.format(aws_accounts[account][0]['acc_name']))
-                        ws.append([bold_cell])
-                        ws.append(['Action', 'Instance Type', 'Region', 'Cache Engine', 'Current Generation', 'Upfront Cost', 'Estimated Monthly Savings'])
-
-                        for i in sort_max:
-                            detail = ri_details[i]
-                            
-                            action = "Buy {0} {1}".format(detail['RecommendedNumberOfInstancesToPurchase'],detail['InstanceDetails']['ElastiCacheInstanceDetails']['NodeType'])
-                            instancetype = detail['InstanceDetails']['ElastiCacheInstanceDetails']['NodeType']
-                            rgn = detail['InstanceDetails']['ElastiCacheInstanceDetails']['Region']
-                            engine = detail['InstanceDetails']['ElastiCacheInstanceDetails']['ProductDescription']
-                            current_gen = str(detail['InstanceDetails']['ElastiCacheInstanceDetails']['CurrentGeneration'])
-                            upcost = decimal.Decimal(detail['UpfrontCost'])
-                            upcost_rounded = str(upcost.quantize(decimal.Decimal('0.00')))
-                            est_saving = decimal.Decimal(detail['EstimatedMonthlySavingsAmount'])
-                            est_sav_rounded = str(est_saving.quantize(decimal.Decimal('0.00')))
-                            BODY_HTML = BODY_HTML + "<tr><td>"+action+"</td><td>"+instancetype+"</td><td>"+rgn+"</td><td>"+engine+"</td><td>"+current_gen+"</td><td>"+upcost_rounded+"</td><td>"+est_sav_rounded+"</td></tr>"
-                            # writing to excel
-                            ws.append([
-                                action,
-                                instancetype,
-                                rgn,
-                                engine,
-                                current_gen,
-                                upcost_rounded,
-                                est_sav_rounded
-                            ])
-                        BODY_HTML = BODY_HTML + "<tr height = 20px></tr>"
-                        BODY_HTML = BODY_HTML + "</tbody></table></div>"
-                        
-                    elif riservice == 'Amazon OpenSearch Service':
-                        BODY_HTML = BODY_HTML + "<h4>RI Recommendations for {0}:</h4>".format(riservice)
-                        BODY_HTML = BODY_HTML + """<div><table style="width:100%">
-                        <thead><tr><td><b style="font-family:'Open Sans';font-size:13px">Action</b></td><td><b style="font-family:'Open Sans';font-size:13px">Instance Type</b></td><td><b style="font-family:'Open Sans';font-size:13px">Region</b></td><td><b style="font-family:'Open Sans';font-size:13px">Current Generation</b></td><td><b style="font-family:'Open Sans';font-size:13px">Upfront Cost</b></td><td><b style="font-family:'Open Sans';font-size:13px">Estimated Monthly Savings</b></td></tr></thead>
-                        <tbody>"""
-                        ri_details = ri_results['Recommendations'][0]['RecommendationDetails']
-                        max_impact = {}
-                        index = 0
-                        
-                        for ri in ri_details:
-                            max_impact[index] = decimal.Decimal(ri['EstimatedMonthlySavingsAmount'])
-                            index += 1
-                        sort_max = sorted(max_impact.items(), key=lambda x:x[1], reverse=True)
-                        sort_max = dict(sort_max)
-
-                        # writing to excel
-                        owner_name = aws_accounts[account][0]['acc_owner'].split('@')[0]
-                        ws = wb_ri[owner_name]
-                        ws.append([])
-                        bold_cell = Cell(ws, value='Amazon OpenSearch Service for account {}'.format(aws_accounts[account][0]['acc_name']))
-                        ws.append([bold_cell])
-                        ws.append(['Action', 'Instance Type', 'Region', 'Current Generation', 'Upfront Cost', 'Estimated Monthly Savings'])
-
-                        for i in sort_max:
-                            detail = ri_details[i]
-                            
-                            action = "Buy {0} {1}".format(detail['RecommendedNumberOfInstancesToPurchase'],detail['InstanceDetails']['ESInstanceDetails']['InstanceSize'])
-                            instancetype = detail['InstanceDetails']['ESInstanceDetails']['InstanceSize']
-                            rgn = detail['InstanceDetails']['ESInstanceDetails']['Region']
-                            current_gen = str(detail['InstanceDetails']['ESInstanceDetails']['CurrentGeneration'])
-                            upcost = decimal.Decimal(detail['UpfrontCost'])
-                            upcost_rounded = str(upcost.quantize(decimal.Decimal('0.00')))
-                            est_saving = decimal.Decimal(detail['EstimatedMonthlySavingsAmount'])
-                            est_sav_rounded = str(est_saving.quantize(decimal.Decimal('0.00')))
-                            BODY_HTML = BODY_HTML + "<tr><td>"+action+"</td><td>"+instancetype+"</td><td>"+rgn+"</td><td>"+current_gen+"</td><td>"+upcost_rounded+"</td><td>"+est_sav_rounded+"</td></tr>"
-                            # writing to excel
-                            ws.append([
-                                action,
-                                instancetype,
-                                rgn,
-                                current_gen,
-                                upcost_rounded,
-                                est_sav_rounded
-                            ])
-                        BODY_HTML = BODY_HTML + "<tr height = 20px></tr>"
-                        BODY_HTML = BODY_HTML + "</tbody></table></div>"
-                    
-                    elif riservice == 'Amazon Elastic Compute Cloud - Compute':
-                        BODY_HTML = BODY_HTML + "<h4>RI Recommendations for {0}:</h4>".format(riservice)
-                        BODY_HTML = BODY_HTML + """<div><table style="width:100%">
-                        <thead><tr><td><b style="font-family:'Open Sans';font-size:13px">Action</b></td><td><b style="font-family:'Open Sans';font-size:13px">Instance Type</b></td><td><b style="font-family:'Open Sans';font-size:13px">Platform</b></td><td><b style="font-family:'Open Sans';font-size:13px">Region</b></td><td><b style="font-family:'Open Sans';font-size:13px">Current Generation</b></td><td><b style="font-family:'Open Sans';font-size:13px">Upfront Cost</b></td><td><b style="font-family:'Open Sans';font-size:13px">Estimated Monthly Savings</b></td></tr></thead>
-                        <tbody>"""
-                        ri_details = ri_results['Recommendations'][0]['RecommendationDetails']
-                        max_impact = {}
-                        index = 0
-                        
-                        for ri in ri_details:
-                            max_impact[index] = decimal.Decimal(ri['EstimatedMonthlySavingsAmount'])
-                            index += 1
-                        sort_max = sorted(max_impact.items(), key=lambda x:x[1], reverse=True)
-                        sort_max = dict(sort_max)
-
-                        # writing to excel
-                        owner_name = aws_accounts[account][0]['acc_owner'].split('@')[0]
-                        ws = wb_ri[owner_name]
-                        ws.append([])
-                        bold_cell = Cell(ws, value='Amazon Elastic Compute Cloud - Compute for account {}'.format(aws_accounts[account][0]['acc_name']))
-                        ws.append([bold_cell])
-                        ws.append(['Action', 'Instance Type', 'Platform', 'Region', 'Current Generation', 'Upfront Cost', 'Estimated Monthly Savings'])
-
-                        for i in sort_max:
-                            detail = ri_details[i]
-                            
-                            action = "Buy {0} {1}".format(detail['RecommendedNumberOfInstancesToPurchase'],detail['InstanceDetails']['EC2InstanceDetails']['InstanceType'])
-                            instancetype = detail['InstanceDetails']['EC2InstanceDetails']['InstanceType']
-                            platform = detail['InstanceDetails']['EC2InstanceDetails']['Platform']
-                            rgn = detail['InstanceDetails']['EC2InstanceDetails']['Region']
-                            current_gen = str(detail['InstanceDetails']['EC2InstanceDetails']['CurrentGeneration'])
-                            upcost = decimal.Decimal(detail['UpfrontCost'])
-                            upcost_rounded = str(upcost.quantize(decimal.Decimal('0.00')))
-                            est_saving = decimal.Decimal(detail['EstimatedMonthlySavingsAmount'])
-                            est_sav_rounded = str(est_saving.quantize(decimal.Decimal('0.00')))
-                            BODY_HTML = BODY_HTML + "<tr><td>"+action+"</td><td>"+instancetype+"</td><td>"+platform+"</td><td>"+rgn+"</td><td>"+current_gen+"</td><td>"+upcost_rounded+"</td><td>"+est_sav_rounded+"</td></tr>"
-                            # writing to excel
-                            ws.append([
-                                action,
-                                instancetype,
-                                platform,
-                                rgn,
-                                current_gen,
-                                upcost_rounded,
-                                est_sav_rounded
-                            ])
-                        BODY_HTML = BODY_HTML + "<tr height = 20px></tr>"
-                        BODY_HTML = BODY_HTML + "</tbody></table></div>"
-                    elif riservice == 'Amazon Redshift':
-                        BODY_HTML = BODY_HTML + "<h4>RI Recommendations for {0}:</h4>".format(riservice)
-                        BODY_HTML = BODY_HTML + """<div><table style="width:100%">
-                        <thead><tr><td><b style="font-family:'Open Sans';font-size:13px">Action</b></td><td><b style="font-family:'Open Sans';font-size:13px">Instance Type</b></td><td><b style="font-family:'Open Sans';font-size:13px">Region</b></td><td><b style="font-family:'Open Sans';font-size:13px">SizeFlex Eligible</b></td><td><b style="font-family:'Open Sans';font-size:13px">Current Generation</b></td><td><b style="font-family:'Open Sans';font-size:13px">Upfront Cost</b></td><td><b style="font-family:'Open Sans';font-size:13px">Estimated Monthly Savings</b></td></tr></thead>
-                        <tbody>"""
-                        ri_details = ri_results['Recommendations'][0]['RecommendationDetails']
-                        max_impact = {}
-                        index = 0
-                        
-                        for ri in ri_details:
-                            max_impact[index] = decimal.Decimal(ri['EstimatedMonthlySavingsAmount'])
-                            index += 1
-                        sort_max = sorted(max_impact.items(), key=lambda x:x[1], reverse=True)
-                        sort_max = dict(sort_max)
-
-                        # writing to excel
-                        owner_name = aws_accounts[account][0]['acc_owner'].split('@')[0]
-                        ws = wb_ri[owner_name]
-                        ws.append([])
-                        bold_cell = Cell(ws, value='Amazon Redshift for account {}'.format(aws_accounts[account][0]['acc_name']))
-                        ws.append([bold_cell])
-                        ws.append(['Action', 'Instance Type', 'Region', 'SizeFlex Eligible', 'Current Generation', 'Upfront Cost', 'Estimated Monthly Savings'])
-
-                        for i in sort_max:
-                            detail = ri_details[i]
-                            
-                            action = "Buy {0} {1}".format(detail['RecommendedNumberOfInstancesToPurchase'],detail['InstanceDetails']['RedshiftInstanceDetails']['NodeType'])
-                            instancetype = detail['InstanceDetails']['RedshiftInstanceDetails']['NodeType']
-                            rgn = detail['InstanceDetails']['RedshiftInstanceDetails']['Region']
-                            sizeflex = str(detail['InstanceDetails']['RedshiftInstanceDetails']['SizeFlexEligible'])
-                            current_gen = str(detail['InstanceDetails']['RedshiftInstanceDetails']['CurrentGeneration'])
-                            upcost = decimal.Decimal(detail['UpfrontCost'])
-                            upcost_rounded = str(upcost.quantize(decimal.Decimal('0.00')))
-                            est_saving = decimal.Decimal(detail['EstimatedMonthlySavingsAmount'])
-                            est_sav_rounded = str(est_saving.quantize(decimal.Decimal('0.00')))
-                            BODY_HTML = BODY_HTML + "<tr><td>"+action+"</td><td>"+instancetype+"</td><td>"+rgn+"</td><td>"+sizeflex+"</td><td>"+current_gen+"</td><td>"+upcost_rounded+"</td><td>"+est_sav_rounded+"</td></tr>"
-                            # writing to excel
-                            ws.append([
-                                action,
-                                instancetype,
-                                rgn,
-                                sizeflex,
-                                current_gen,
-                                upcost_rounded,
-                                est_sav_rounded
-                            ])
-                        BODY_HTML = BODY_HTML + "<tr height = 20px></tr>"
-                        BODY_HTML = BODY_HTML + "</tbody></table></div>"
-                        
-            BODY_HTML = BODY_HTML + "<h4>######################################</h4>"
-        else:
-            remote_client = get_client(account, 'us-east-1', 'ce')
-            results = remote_client.get_cost_and_usage(
-                TimePeriod={
-                    'Start': str(start_week),
-                    'End': str(end_week)
-                },
-                Granularity='MONTHLY',
-                Metrics=[
-                    'AmortizedCost',
-                ],
-                GroupBy=[
-                    {
-                        'Type': 'DIMENSION',
-                        'Key': 'SERVICE'
-                    },
-                ],
-            )
-            month_results = remote_client.get_cost_and_usage(
-                TimePeriod={
-                    'Start': str(month_start_date),
-                    'End': str(end_week)
-                },
-                Granularity='MONTHLY',
-                Metrics=[
-                    'AmortizedCost',
-                ]
-            )
-            if month_results.get('ResultsByTime'):
-                uptodate_cost = month_results.get('ResultsByTime')[0]['Total']['AmortizedCost']['Amount']
-                decimalMonth = decimal.Decimal(uptodate_cost)
-                roundedMonth = decimalMonth.quantize(decimal.Decimal('0.00'))
-            get_services = results.get('ResultsByTime')[0]['Groups']
-            for service in get_services:
-                service_name = service.get('Keys')[0]
-                amount = service.get('Metrics')['AmortizedCost']['Amount']
-                decimalAmount = decimal.Decimal(amount)
-                roundedAmount = decimalAmount.quantize(decimal.Decimal('0.00'))
-                db[service_name] = roundedAmount
-                total_cost = total_cost + roundedAmount
-                #BODY_HTML = BODY_HTML + "<tr><td>"+account+"</td><td>"+service_name+"</td><td>"+str(roundedAmount)+"</td></tr>"
-            sorted_dict = sorted(db.items(), key=lambda x:x[1], reverse=True)
-            sorted_dict = dict(sorted_dict)
-            index = 0
-            n = 1
-            #print("Sorted Dictionary: {}".format(sorted_dict))
-            BODY_HTML = BODY_HTML + "<h4>Account Owner: {}</h4>".format(aws_accounts[account][0]['acc_owner'])
-            BODY_HTML = BODY_HTML + """<div><table style="width:100%">
-            <thead><tr><td><b style="font-family:'Open Sans';font-size:13px">Account No</b></td><td><b style="font-family:'Open Sans';font-size:13px">Account Name</b></td><td><b style="font-family:'Open Sans';font-size:13px">Service Name</b></td><td><b style="font-family:'Open Sans';font-size:13px">AWS Cost</b></td></tr></thead>
-            <tbody>"""
-            for i in sorted_dict:
-                index += 1
-                if n == 1:
-                    BODY_HTML = BODY_HTML + "<tr><td style=font-weight:bold>"+account+"</td><td style=font-weight:bold>"+aws_accounts[account][0]['acc_name']+"</td><td style=font-weight:bold>"+i+"</td><td style=font-weight:bold>"+str(sorted_dict[i])+"</td></tr>"
-                    n += 1
-                    #writing to excel
-                    owner_name = aws_accounts[account][0]['acc_owner'].split('@')[0]
-                    ws = wb[owner_name]
-                    ws.append([
-                        account,
-                        aws_accounts[account][0]['acc_name'],
-                        i,
-                        str(sorted_dict[i]),
-                        '-',
-                        '-',
-                        '-',
-                        '-',
-                        '-',
-                        '-',
-                        '-'
-                    ])
-                else:
-                    BODY_HTML = BODY_HTML + "<tr><td>"+account+"</td><td>"+aws_accounts[account][0]['acc_name']+"</td><td>"+i+"</td><td>"+str(sorted_dict[i])+"</td></tr>"
-                    #writing to excel
-                    owner_name = aws_accounts[account][0]['acc_owner'].split('@')[0]
-                    ws = wb[owner_name]
-                    ws.append([
-                        account,
-                        aws_accounts[account][0]['acc_name'],
-                        i,
-                        str(sorted_dict[i]),
-                        '-',
-                        '-',
-                        '-',
-                        '-',
-                        '-',
-                        '-',
-                        '-'
-                    ])                
-                    if index > 9:
-                        break
-                    
-            ##### Getting monthly budget limit #####
-            budget_client = get_client(account, 'us-east-1', 'budgets')
-            budget_name = 'finops-ACCOUNT_' + account + '_MONTHLY_' + str(current_year)
+
+def deliver(html, wb, wb_ri, start_week, end_week_title, destinations, owner_name=None):
+
+    suffix = '_' + owner_name if owner_name else ''
+    with metrics.timer('WorkbookSave'):
+        xlfile = workbook_attachment(wb, 'AWSCOST_WeeklyReport_{0}_to_{1}{2}.xlsx'.format(start_week,end_week_title,suffix))
+        xlrifile = workbook_attachment(wb_ri, 'AWSCOST_RIReport_{0}_to_{1}{2}.xlsx'.format(start_week,end_week_title,suffix))
+    metrics.add('WorkbookBytes', xlfile.size, unit='Bytes')
+    metrics.add('RIWorkbookBytes', xlrifile.size, unit='Bytes')
+
+    with metrics.timer('S3Upload'):
+        upload_attachment(xlfile, 'aws-ce-reports')
+
+    attachments = [xlfile, xlrifile]
+    if ATTACHMENT_COMPRESSION == 'zip':
+        attachments = [zip_attachments(attachments, 'AWSCOST_Reports_{0}_to_{1}{2}.zip'.format(start_week,end_week_title,suffix))]
+    if sum(attachment.size for attachment in attachments) > ATTACHMENT_LINK_BYTES:
+        # too large for SES, the email links to the reports in S3
+        html.write(ATTACHMENT_LINKS.format(LINK_EXPIRY // 3600))
+        with metrics.timer('S3Upload'):
+            for attachment in attachments:
+                if attachment is not xlfile:
+                    upload_attachment(attachment, 'aws-ce-reports')
+                html.write(ATTACHMENT_LINK.format(attachment_link(attachment, 'aws-ce-reports'), attachment.name))
+        attachments = []
+
+    html.write(HTML_SIGNATURE)
+
+    with metrics.timer('SesSend'):
+        send_email_with_attachment(start_week, end_week_title, html, attachments, SES_REGION, destinations)
+
+
+def set_send_rate(ses_region):
+
+    # one message per owner, so the SES limiter runs at the send rate of the account
+    try:
+        quota = get_local_client('ses', ses_region).get_send_quota()
+    except ClientError as e:
+        logging.error(e)
+        return
+    get_bucket('local', 'ses').set_rate(quota['MaxSendRate'])
+
+
+def send_owner_reports(reports, start_week, end_week_title, last_account):
+
+    set_send_rate(SES_REGION)
+    sends = []
+    failed = []
+    with ThreadPoolExecutor(max_workers=SES_WORKERS) as send_pool:
+        # an owner is sent as soon as their last account is rendered, so only owners
+        # with accounts still to come are held in memory
+        building = {}
+        for report in reports:
+            owner_name = report.owner_name
+            if owner_name not in building:
+                html = HtmlReport(HTML_SPOOL_BYTES)
+                html.write(HTML_INTRO.format(start_week, end_week_title))
+                building[owner_name] = (html,) + new_workbooks([owner_name])
+            html, wb, wb_ri = building[owner_name]
+            with metrics.timer('HtmlBuild'):
+                render_html(html, report)
+            with metrics.timer('WorkbookBuild'):
+                render_xlsx(wb, wb_ri, report)
+            if last_account[owner_name] == report.account:
+                del building[owner_name]
+                sends.append((report.owner, send_pool.submit(deliver, html, wb, wb_ri, start_week, end_week_title, [report.owner], owner_name)))
+        # one failed message does not stop the others
+        for owner, future in sends:
             try:
-                budget_response = budget_client.describe_budget(
-                    AccountId = account,
-                    BudgetName = budget_name
-                    )
-                if budget_response.get('Budget'):
-                    budgeted_amount = budget_response['Budget']['BudgetLimit'].get('Amount')
-                    weekly_budget = decimal.Decimal(budgeted_amount) / 4
-                    weekly_budget_rounded = weekly_budget.quantize(decimal.Decimal('0.00'))
-                    if total_cost > weekly_budget_rounded:
-                        BODY_HTML = BODY_HTML + "<tr height = 20px></tr>"
-                        BODY_HTML = BODY_HTML + "<tr colspan=2><td><span style='font-weight:bold;background-color: yellow'>"+"[!!Weekly budget limit exceeded!!] Total cost for all services this week == ${}".format(total_cost)+"</span></td>"
-                    else:
-                        BODY_HTML = BODY_HTML + "<tr height = 20px></tr>"
-                        BODY_HTML = BODY_HTML + "<tr colspan=2><td><span style=font-weight:bold>"+"Total cost for all services this week == ${}".format(total_cost)+"</span></td>"
-                
-            except ClientError:
-                budget_response = budget_client.describe_budgets(
-                    AccountId = account
-                )
-                if budget_response.get('Budgets'):
-                    budgeted_amount = budget_response['Budgets'][0]['BudgetLimit'].get('Amount')
-                    weekly_budget = decimal.Decimal(budgeted_amount) / 4
-                    weekly_budget_rounded = weekly_budget.quantize(decimal.Decimal('0.00'))
-                    if total_cost > weekly_budget_rounded:
-                        BODY_HTML = BODY_HTML + "<tr height = 20px></tr>"
-                        BODY_HTML = BODY_HTML + "<tr colspan=2><td><span style='font-weight:bold;background-color: yellow'>"+"[!!Weekly budget limit exceeded!!] Total cost for all services this week == ${}".format(total_cost)+"</span></td>"
-                    else:
-                        BODY_HTML = BODY_HTML + "<tr height = 20px></tr>"
-                        BODY_HTML = BODY_HTML + "<tr colspan=2><td><span style=font-weight:bold>"+"Total cost for all services this week == ${}".format(total_cost)+"</span></td>"
-                #BODY_HTML = BODY_HTML + "<tr colspan=2><td><span style=font-weight:bold>"+"Total cost for all services this week == ${}".format(total_cost)+"</span></td>"
-            BODY_HTML = BODY_HTML + "<tr colspan=2><td><span style=font-weight:bold>"+"Overall spend for the account in this month == ${}".format(roundedMonth)+"</span></td>"
-            BODY_HTML = BODY_HTML + "<tr height = 20px></tr>"
-            BODY_HTML = BODY_HTML + "</tbody></table></div>"
-            ##### Getting Anomaly data #####
-            ano_results = remote_client.get_anomalies(
-                DateInterval={
-                    'StartDate': str(start_week),
-                    'EndDate': str(end_week)
-                },
-                MonitorArn = aws_accounts[account][0]['ano_arn']
-            )
-            if ano_results['Anomalies']:
-                BODY_HTML = BODY_HTML + "<h4>Anomaly Details for the account {0} ({1}):</h4>".format(account, aws_accounts[account][0]['acc_name'])
-                BODY_HTML = BODY_HTML + """<div><table style="width:100%">
-                <thead><tr><td><b style="font-family:'Open Sans';font-size:13px">Service</b></td><td><b style="font-family:'Open Sans';font-size:13px">Start Date</b></td><td><b style="font-family:'Open Sans';font-size:13px">End Date</b></td><td><b style="font-family:'Open Sans';font-size:13px">Region</b></td><td><b style="font-family:'Open Sans';font-size:13px">UsageType</b></td><td><b style="font-family:'Open Sans';font-size:13px">Max Impact</b></td><td><b style="font-family:'Open Sans';font-size:13px">Total Impact</b></td></tr></thead>
-                <tbody>"""
-                details = ano_results['Anomalies']
-                maximpact = {}
-                index = 0
-                for element in details:
-                    maximpact[index] = element['Impact']['MaxImpact']
-                    index += 1
-                sort_max = sorted(maximpact.items(), key=lambda x:x[1], reverse=True)
-                sort_max = dict(sort_max)
-                for i in sort_max.keys():
-                    detail = details[i]
-                    ano_startdate = ((detail['AnomalyStartDate']).split("T"))[0]
-                    ano_enddate = ((detail['AnomalyEndDate']).split("T"))[0]
-                    if detail['RootCauses']:
-                        if detail['RootCauses'][0].get('Region'):
-                            region = detail['RootCauses'][0]['Region']
-                        else:
-                            region = '-'
-                    else:
-                        region = '-'
-                        
-                    if detail['RootCauses']:
-                        if detail['RootCauses'][0].get('UsageType'):
-                            usage_type = detail['RootCauses'][0]['UsageType']
-                        else:
-                            usage_type = '-'
-                    else:
-                        usage_type = '-'
-                    BODY_HTML = BODY_HTML + "<tr><td>"+detail['DimensionValue']+"</td><td>"+ano_startdate+"</td><td>"+ano_enddate+"</td><td>"+region+"</td><td>"+usage_type+"</td><td>"+str(detail['Impact']['MaxImpact'])+"</td><td>"+str(detail['Impact']['TotalImpact'])+"</td></tr>"
-                    #writing to excel
-                    owner_name = aws_accounts[account][0]['acc_owner'].split('@')[0]
-                    ws = wb[owner_name]
-                    ws.append([
-                        account,
-                        aws_accounts[account][0]['acc_name'],
-                        '-',
-                        '-',
-                        detail['DimensionValue'],
-                        ano_startdate,
-                        ano_enddate,
-                        region,
-                        usage_type,
-                        str(detail['Impact']['MaxImpact']),
-                        str(detail['Impact']['TotalImpact'])
-                    ])                            
-                BODY_HTML = BODY_HTML + "<tr height = 20px></tr>"
-                BODY_HTML = BODY_HTML + "</tbody></table></div>"
-            
-            ##### Getting RI recommendations #####
-            for riservice in ri_services:
-                ri_results = remote_client.get_reservation_purchase_recommendation(
-                    AccountId = account,
-                    Service = riservice,
-                    TermInYears = 'ONE_YEAR',
-                    LookbackPeriodInDays = 'THIRTY_DAYS',
-                    PaymentOption = 'ALL_UPFRONT'
-                )
-                
-                if ri_results.get('Recommendations'):
-                    #BODY_HTML = BODY_HTML + "<h4>RI Recommendations for the account {0} ({1}):</h4>".format(account, aws_accounts[account][0]['acc_name'])
-                    
-                    if riservice == 'Amazon Relational Database Service':
-                        BODY_HTML = BODY_HTML + "<h4>RI Recommendations for {0} (RDS):</h4>".format(riservice)
-                        BODY_HTML = BODY_HTML + """<div><table style="width:100%">
-                        <thead><tr><td><b style="font-family:'Open Sans';font-size:13px">Action</b></td><td><b style="font-family:'Open Sans';font-size:13px">Instance Type</b></td><td><b style="font-family:'Open Sans';font-size:13px">Region</b></td><td><b style="font-family:'Open Sans';font-size:13px">Database</b></td><td><b style="font-family:'Open Sans';font-size:13px">License</b></td><td><b style="font-family:'Open Sans';font-size:13px">Current Generation</b></td><td><b style="font-family:'Open Sans';font-size:13px">Upfront Cost</b></td><td><b style="font-family:'Open Sans';font-size:13px">Estimated Monthly Savings</b></td></tr></thead>
-                        <tbody>"""                        
-                        ri_details = ri_results['Recommendations'][0]['RecommendationDetails']
-                        maximpact = {}
-                        index = 0
-                        for ri in ri_details:
-                            maximpact[index] = decimal.Decimal(ri['EstimatedMonthlySavingsAmount'])
-                            index += 1
-                        sort_max = sorted(maximpact.items(), key=lambda x:x[1], reverse=True)
-                        sort_max = dict(sort_max)
-
-                        # writing to excel
-                        owner_name = aws_accounts[account][0]['acc_owner'].split('@')[0]
-                        ws = wb_ri[owner_name]
-                        ws.append([])
-                        bold_cell = Cell(ws, value='Amazon RDS for account {}'.format(aws_accounts[account][0]['acc_name']))
-                        ws.append([bold_cell])
-                        ws.append(['Action', 'Instance Type', 'Region', 'Database', 'License', 'Current Generation', 'Upfront Cost', 'Estimated Monthly Savings'])
-                        
-                        for i in sort_max.keys():
-                            detail = ri_details[i]
-                            action = "Buy {0} {1}".format(detail['RecommendedNumberOfInstancesToPurchase'],detail['InstanceDetails']['RDSInstanceDetails']['InstanceType'])
-                            instancetype = detail['InstanceDetails']['RDSInstanceDetails']['InstanceType']
-                            rgn = detail['InstanceDetails']['RDSInstanceDetails']['Region']
-                            database = detail['InstanceDetails']['RDSInstanceDetails']['DatabaseEngine']
-                            licen = detail['InstanceDetails']['RDSInstanceDetails']['LicenseModel']
-                            current_gen = str(detail['InstanceDetails']['RDSInstanceDetails']['CurrentGeneration'])
-                            upcost = decimal.Decimal(detail['UpfrontCost'])
-                            upcost_rounded = str(upcost.quantize(decimal.Decimal('0.00')))
-                            est_saving = decimal.Decimal(detail['EstimatedMonthlySavingsAmount'])
-                            est_sav_rounded = str(est_saving.quantize(decimal.Decimal('0.00')))
-                            
-                            BODY_HTML = BODY_HTML + "<tr><td>"+action+"</td><td>"+instancetype+"</td><td>"+rgn+"</td><td>"+database+"</td><td>"+licen+"</td><td>"+current_gen+"</td><td>"+upcost_rounded+"</td><td>"+est_sav_rounded+"</td></tr>"
-                            # writing to excel
-                            ws.append([
-                                action,
-                                instancetype,
-                                rgn,
-                                database,
-                                licen,
-                                current_gen,
-                                upcost_rounded,
-                                est_sav_rounded
-                                ])
-
-                        BODY_HTML = BODY_HTML + "<tr height = 20px></tr>"
-                        BODY_HTML = BODY_HTML + "</tbody></table></div>"
-                    
-                    elif riservice == 'Amazon ElastiCache':
-                        BODY_HTML = BODY_HTML + "<h4>RI Recommendations for {0}:</h4>".format(riservice)
-                        BODY_HTML = BODY_HTML + """<div><table style="width:100%">
-                        <thead><tr><td><b style="font-family:'Open Sans';font-size:13px">Action</b></td><td><b style="font-family:'Open Sans';font-size:13px">Instance Type</b></td><td><b style="font-family:'Open Sans';font-size:13px">Region</b></td><td><b style="font-family:'Open Sans';font-size:13px">Cache Engine</b></td><td><b style="font-family:'Open Sans';font-size:13px">Current Generation</b></td><td><b style="font-family:'Open Sans';font-size:13px">Upfront Cost</b></td><td><b style="font-family:'Open Sans';font-size:13px">Estimated Monthly Savings</b></td></tr></thead>
-                        <tbody>"""
-                        ri_details = ri_results['Recommendations'][0]['RecommendationDetails']
-                        max_impact = {}
-                        index = 0
-                        
-                        for ri in ri_details:
-                            max_impact[index] = decimal.Decimal(ri['EstimatedMonthlySavingsAmount'])
-                            index += 1
-                        sort_max = sorted(max_impact.items(), key=lambda x:x[1], reverse=True)
-                        sort_max = dict(sort_max)
-
-                        # writing to excel
-                        owner_name = aws_accounts[account][0]['acc_owner'].split('@')[0]
-                        ws = wb_ri[owner_name]
-                        ws.append([])
-                        bold_cell = Cell(ws, value='Amazon ElastiCache for account {}'.format(aws_accounts[account][0]['acc_name']))
-                        ws.append([bold_cell])
-                        ws.append(['Action', 'Instance Type', 'Region', 'Cache Engine', 'Current Generation', 'Upfront Cost', 'Estimated Monthly Savings'])
-
-                        for i in sort_max:
-                            detail = ri_details[i]
-                            
-                            action = "Buy {0} {1}".format(detail['RecommendedNumberOfInstancesToPurchase'],detail['InstanceDetails']['ElastiCacheInstanceDetails']['NodeType'])
-                            instancetype = detail['InstanceDetails']['ElastiCacheInstanceDetails']['NodeType']
-                            rgn = detail['InstanceDetails']['ElastiCacheInstanceDetails']['Region']
-                            engine = detail['InstanceDetails']['ElastiCacheInstanceDetails']['ProductDescription']
-                            current_gen = str(detail['InstanceDetails']['ElastiCacheInstanceDetails']['CurrentGeneration'])
-                            upcost = decimal.Decimal(detail['UpfrontCost'])
-                            upcost_rounded = str(upcost.quantize(decimal.Decimal('0.00')))
-                            est_saving = decimal.Decimal(detail['EstimatedMonthlySavingsAmount'])
-                            est_sav_rounded = str(est_saving.quantize(decimal.Decimal('0.00')))
-                            BODY_HTML = BODY_HTML + "<tr><td>"+action+"</td><td>"+instancetype+"</td><td>"+rgn+"</td><td>"+engine+"</td><td>"+current_gen+"</td><td>"+upcost_rounded+"</td><td>"+est_sav_rounded+"</td></tr>"
-
-                            # writing to excel
-                            ws.append([
-                                action,
-                                instancetype,
-                                rgn,
-                                engine,
-                                current_gen,
-                                upcost_rounded,
-                                est_sav_rounded
-                            ])
-                        BODY_HTML = BODY_HTML + "<tr height = 20px></tr>"
-                        BODY_HTML = BODY_HTML + "</tbody></table></div>"
-                        
-                    elif riservice == 'Amazon OpenSearch Service':
-                        BODY_HTML = BODY_HTML + "<h4>RI Recommendations for {0}:</h4>".format(riservice)
-                        BODY_HTML = BODY_HTML + """<div><table style="width:100%">
-                        <thead><tr><td><b style="font-family:'Open Sans';font-size:13px">Action</b></td><td><b style="font-family:'Open Sans';font-size:13px">Instance Type</b></td><td><b style="font-family:'Open Sans';font-size:13px">Region</b></td><td><b style="font-family:'Open Sans';font-size:13px">Current Generation</b></td><td><b style="font-family:'Open Sans';font-size:13px">Upfront Cost</b></td><td><b style="font-family:'Open Sans';font-size:13px">Estimated Monthly Savings</b></td></tr></thead>
-                        <tbody>"""
-                        ri_details = ri_results['Recommendations'][0]['RecommendationDetails']
-                        max_impact = {}
-                        index = 0
-                        
-                        for ri in ri_details:
-                            max_impact[index] = decimal.Decimal(ri['EstimatedMonthlySavingsAmount'])
-                            index += 1
-                        sort_max = sorted(max_impact.items(), key=lambda x:x[1], reverse=True)
-                        sort_max = dict(sort_max)
-
-                        # writing to excel
-                        owner_name = aws_accounts[account][0]['acc_owner'].split('@')[0]
-                        ws = wb_ri[owner_name]
-                        ws.append([])
-                        bold_cell = Cell(ws, value='Amazon OpenSearch Service for account {}'.format(aws_accounts[account][0]['acc_name']))
-                        ws.append([bold_cell])
-                        ws.append(['Action', 'Instance Type', 'Region', 'Current Generation', 'Upfront Cost', 'Estimated Monthly Savings'])
-
-                        for i in sort_max:
-                            detail = ri_details[i]
-                            
-                            action = "Buy {0} {1}".format(detail['RecommendedNumberOfInstancesToPurchase'],detail['InstanceDetails']['ESInstanceDetails']['InstanceSize'])
-                            instancetype = detail['InstanceDetails']['ESInstanceDetails']['InstanceSize']
-                            rgn = detail['InstanceDetails']['ESInstanceDetails']['Region']
-                            current_gen = str(detail['InstanceDetails']['ESInstanceDetails']['CurrentGeneration'])
-                            upcost = decimal.Decimal(detail['UpfrontCost'])
-                            upcost_rounded = str(upcost.quantize(decimal.Decimal('0.00')))
-                            est_saving = decimal.Decimal(detail['EstimatedMonthlySavingsAmount'])
-                            est_sav_rounded = str(est_saving.quantize(decimal.Decimal('0.00')))
-                            BODY_HTML = BODY_HTML + "<tr><td>"+action+"</td><td>"+instancetype+"</td><td>"+rgn+"</td><td>"+current_gen+"</td><td>"+upcost_rounded+"</td><td>"+est_sav_rounded+"</td></tr>"
-
-                            # writing to excel
-                            ws.append([
-                                action,
-                                instancetype,
-                                rgn,
-                                current_gen,
-                                upcost_rounded,
-                                est_sav_rounded
-                            ])
-                        BODY_HTML = BODY_HTML + "<tr height = 20px></tr>"
-                        BODY_HTML = BODY_HTML + "</tbody></table></div>"
-                    
-                    elif riservice == 'Amazon Elastic Compute Cloud - Compute':
-                        BODY_HTML = BODY_HTML + "<h4>RI Recommendations for {0}:</h4>".format(riservice)
-                        BODY_HTML = BODY_HTML + """<div><table style="width:100%">
-                        <thead><tr><td><b style="font-family:'Open Sans';font-size:13px">Action</b></td><td><b style="font-family:'Open Sans';font-size:13px">Instance Type</b></td><td><b style="font-family:'Open Sans';font-size:13px">Platform</b></td><td><b style="font-family:'Open Sans';font-size:13px">Region</b></td><td><b style="font-family:'Open Sans';font-size:13px">Current Generation</b></td><td><b style="font-family:'Open Sans';font-size:13px">Upfront Cost</b></td><td><b style="font-family:'Open Sans';font-size:13px">Estimated Monthly Savings</b></td></tr></thead>
-                        <tbody>"""
-                        ri_details = ri_results['Recommendations'][0]['RecommendationDetails']
-                        max_impact = {}
-                        index = 0
-                        
-                        for ri in ri_details:
-                            max_impact[index] = decimal.Decimal(ri['EstimatedMonthlySavingsAmount'])
-                            index += 1
-                        sort_max = sorted(max_impact.items(), key=lambda x:x[1], reverse=True)
-                        sort_max = dict(sort_max)
-
-                        # writing to excel
-                        owner_name = aws_accounts[account][0]['acc_owner'].split('@')[0]
-                        ws = wb_ri[owner_name]
-                        ws.append([])
-                        bold_cell = Cell(ws, value='Amazon EC2 for account {}'.format(aws_accounts[account][0]['acc_name']))
-                        ws.append([bold_cell])
-                        ws.append(['Action', 'Instance Type', 'Platform', 'Region', 'Current Generation', 'Upfront Cost', 'Estimated Monthly Savings'])
-
-                        for i in sort_max:
-                            detail = ri_details[i]
-                            
-                            action = "Buy {0} {1}".format(detail['RecommendedNumberOfInstancesToPurchase'],detail['InstanceDetails']['EC2InstanceDetails']['InstanceType'])
-                            instancetype = detail['InstanceDetails']['EC2InstanceDetails']['InstanceType']
-                            platform = detail['InstanceDetails']['EC2InstanceDetails']['Platform']
-                            rgn = detail['InstanceDetails']['EC2InstanceDetails']['Region']
-                            current_gen = str(detail['InstanceDetails']['EC2InstanceDetails']['CurrentGeneration'])
-                            upcost = decimal.Decimal(detail['UpfrontCost'])
-                            upcost_rounded = str(upcost.quantize(decimal.Decimal('0.00')))
-                            est_saving = decimal.Decimal(detail['EstimatedMonthlySavingsAmount'])
-                            est_sav_rounded = str(est_saving.quantize(decimal.Decimal('0.00')))
-                            BODY_HTML = BODY_HTML + "<tr><td>"+action+"</td><td>"+instancetype+"</td><td>"+platform+"</td><td>"+rgn+"</td><td>"+current_gen+"</td><td>"+upcost_rounded+"</td><td>"+est_sav_rounded+"</td></tr>"
-
-                            # writing to excel
-                            ws.append([
-                                action,
-                                instancetype,
-                                platform,
-                                rgn,
-                                current_gen,
-                                upcost_rounded,
-                                est_sav_rounded
-                            ])
-                        BODY_HTML = BODY_HTML + "<tr height = 20px></tr>"
-                        BODY_HTML = BODY_HTML + "</tbody></table></div>"
-                    elif riservice == 'Amazon Redshift':
-                        BODY_HTML = BODY_HTML + "<h4>RI Recommendations for {0}:</h4>".format(riservice)
-                        BODY_HTML = BODY_HTML + """<div><table style="width:100%">
-                        <thead><tr><td><b style="font-family:'Open Sans';font-size:13px">Action</b></td><td><b style="font-family:'Open Sans';font-size:13px">Instance Type</b></td><td><b style="font-family:'Open Sans';font-size:13px">Region</b></td><td><b style="font-family:'Open Sans';font-size:13px">SizeFlex Eligible</b></td><td><b style="font-family:'Open Sans';font-size:13px">Current Generation</b></td><td><b style="font-family:'Open Sans';font-size:13px">Upfront Cost</b></td><td><b style="font-family:'Open Sans';font-size:13px">Estimated Monthly Savings</b></td></tr></thead>
-                        <tbody>"""
-                        ri_details = ri_results['Recommendations'][0]['RecommendationDetails']
-                        max_impact = {}
-                        index = 0
-                        
-                        for ri in ri_details:
-                            max_impact[index] = decimal.Decimal(ri['EstimatedMonthlySavingsAmount'])
-                            index += 1
-                        sort_max = sorted(max_impact.items(), key=lambda x:x[1], reverse=True)
-                        sort_max = dict(sort_max)
-
-                        # writing to excel
-                        owner_name = aws_accounts[account][0]['acc_owner'].split('@')[0]
-                        ws = wb_ri[owner_name]
-                        ws.append([])
-                        bold_cell = Cell(ws, value='Amazon Redshift for account {}'.format(aws_accounts[account][0]['acc_name']))
-                        ws.append([bold_cell])
-                        ws.append(['Action', 'Instance Type', 'Region', 'SizeFlex Eligible', 'Current Generation', 'Upfront Cost', 'Estimated Monthly Savings'])
-
-                        for i in sort_max:
-                            detail = ri_details[i]
-                            
-                            action = "Buy {0} {1}".format(detail['RecommendedNumberOfInstancesToPurchase'],detail['InstanceDetails']['RedshiftInstanceDetails']['NodeType'])
-                            instancetype = detail['InstanceDetails']['RedshiftInstanceDetails']['NodeType']
-                            rgn = detail['InstanceDetails']['RedshiftInstanceDetails']['Region']
-                            sizeflex = str(detail['InstanceDetails']['RedshiftInstanceDetails']['SizeFlexEligible'])
-                            current_gen = str(detail['InstanceDetails']['RedshiftInstanceDetails']['CurrentGeneration'])
-                            upcost = decimal.Decimal(detail['UpfrontCost'])
-                            upcost_rounded = str(upcost.quantize(decimal.Decimal('0.00')))
-                            est_saving = decimal.Decimal(detail['EstimatedMonthlySavingsAmount'])
-                            est_sav_rounded = str(est_saving.quantize(decimal.Decimal('0.00')))
-                            BODY_HTML = BODY_HTML + "<tr><td>"+action+"</td><td>"+instancetype+"</td><td>"+rgn+"</td><td>"+sizeflex+"</td><td>"+current_gen+"</td><td>"+upcost_rounded+"</td><td>"+est_sav_rounded+"</td></tr>"
-
-                            # writing to excel
-                            ws.append([
-                                action,
-                                instancetype,
-                                rgn,
-                                sizeflex,
-                                current_gen,
-                                upcost_rounded,
-                                est_sav_rounded
-                            ])
-                        BODY_HTML = BODY_HTML + "<tr height = 20px></tr>"
-                        BODY_HTML = BODY_HTML + "</tbody></table></div>"
-            BODY_HTML = BODY_HTML + "<h4>######################################</h4>"
-    
-    # setting excel file column width
-    for sheet in wb.sheetnames: 
-        ws = wb[sheet]
-        col_width = max(len(str(cell.value)) for row in ws for cell in row)
-        for col_idx, column in enumerate(ws.columns, start=1):
-            column_letter = get_column_letter(col_idx)
-            adjusted_width = (col_width + 2) * 0.8
-            ws.column_dimensions[column_letter].width = adjusted_width
+                future.result()
+            except Exception as e:
+                logging.error('Report for %s not sent: %s', owner, e)
+                failed.append(owner)
+    metrics.add('Emails', len(sends) - len(failed))
+    metrics.add('EmailFailures', len(failed))
+    print('Owner reports sent: ', len(sends) - len(failed), ' failed: ', failed)
+
+
+def send_report(reports, start_week, end_week_title):
+
+    worksheet_owner, last_account = report_owners()
+    if DELIVERY_MODE == 'owner':
+        send_owner_reports(reports, start_week, end_week_title, last_account)
+        return
+
+    html = HtmlReport(HTML_SPOOL_BYTES)
+    html.write(HTML_INTRO.format(start_week, end_week_title))
+    wb, wb_ri = new_workbooks(worksheet_owner)
+    table = CostTable()
+
+    for report in reports:
+        with metrics.timer('HtmlBuild'):
+            render_html(html, report)
+        with metrics.timer('WorkbookBuild'):
+            render_xlsx(wb, wb_ri, report)
+        table.add(report)
+
+    if ORG_SUMMARY:
+        with metrics.timer('HtmlBuild'):
+            render_summary(html, table)
+    deliver(html, wb, wb_ri, start_week, end_week_title, recipients)
+
+
+def finish_run():
+
+    print('STS and client cache: ', client_cache_stats)
+    print('API calls, throttles and rate limit wait: ', rate_limit_stats)
+    cache = get_cache()
+    if cache is not None:
+        cache.sync()
+        print('Cost Explorer cache hit rate: {:.1%} '.format(cache.hit_rate()), cache.stats)
+    if METRICS_NAMESPACE:
+        metrics.emit(rate_limit_stats)
+
+
+def load_report_modules():
+
+    # the modules only needed to render and send the report
+    with metrics.timer('ReportModulesImport'):
+        import openpyxl.cell
+        import openpyxl.styles
+        import openpyxl.utils
+        import email.mime.application
+        import email.mime.multipart
+        import email.mime.nonmultipart
+
+
+def start_run():
+
+    global _cold_start
+    reset_rate_limit_stats()
+    reset_client_cache_stats()
+    metrics.reset()
+    # a warm container reports the hit rate of this invocation only
+    if _cache is not None:
+        _cache.reset_stats()
+    if _cold_start:
+        _cold_start = False
+        metrics.add('ColdStart', 1)
+        metrics.add('ModuleImport', IMPORT_MILLISECONDS, unit='Milliseconds')
+
+
+def lambda_handler(event, context):
     
-    for sheet in wb_ri.sheetnames: 
-        ws = wb_ri[sheet]
-        col_width = max(len(str(cell.value)) for row in ws for cell in row)
-        for col_idx, column in enumerate(ws.columns, start=1):
-            column_letter = get_column_letter(col_idx)
-            adjusted_width = (col_width + 2) * 0.8
-            ws.column_dimensions[column_letter].width = adjusted_width
-
-    wb.save('/tmp/AWSCOST_WeeklyReport_{0}_to_{1}.xlsx'.format(start_week,end_week_title))
-    wb_ri.save('/tmp/AWSCOST_RIReport_{0}_to_{1}.xlsx'.format(start_week,end_week_title))
-    xlfile = ('/tmp/AWSCOST_WeeklyReport_{0}_to_{1}.xlsx'.format(start_week,end_week_title))
-    xlrifile = ('/tmp/AWSCOST_RIReport_{0}_to_{1}.xlsx'.format(start_week,end_week_title))
-
-    tmp_files = list()
-    tmp_files = [xlfile, xlrifile]
-
-    BODY_HTML = BODY_HTML + """Thank you,<br>
-    DevOps Team<br>
-    DevOps@company.com"""
+    start_run()
+    start_week, end_week, end_week_title, month_start_date, current_year = report_week()
+
+    # an event with accounts or a shard index only collects its part of the organization,
+    # merge_handler sends the report once every shard is written
+    shard = get_shard(event)
+    if shard is not None:
+        shard_name, accounts = shard
+        run = shard_run(event)
+        use_cache_key(shard_cache_key(shard_name))
+        reports = collect_accounts(accounts, start_week, end_week, month_start_date, current_year)
+        write_shard(shard_name, start_week, run, export_reports(reports, start_week))
+    else:
+        use_cache_key(CACHE_S3_KEY)
+        # the report modules load while the accounts are collected
+        threading.Thread(target=load_report_modules, daemon=True).start()
+        accounts = aws_accounts.keys()
+        reports = collect_accounts(accounts, start_week, end_week, month_start_date, current_year)
+        send_report(export_reports(reports, start_week), start_week, end_week_title)
+    finish_run()
+
+
+def merge_handler(event, context):
+
+    start_run()
+    threading.Thread(target=load_report_modules, daemon=True).start()
+    start_week, end_week, end_week_title, month_start_date, current_year = report_week()
+    use_cache_key(CACHE_S3_KEY)
+
+    run = shard_run(event)
+    reports, shard_names = read_shards(start_week, run)
+    # accounts of shards that failed or never ran are collected here
+    missing = [account for account in aws_accounts if account not in reports]
+    if missing:
+        print('Accounts missing from the shards, collecting them now: ', missing)
+        # the shards exported their accounts, only these are exported here
+        collected = collect_accounts(missing, start_week, end_week, month_start_date, current_year)
+        for report in export_reports(collected, start_week):
+            reports[report.account] = report
+    send_report((reports[account] for account in aws_accounts), start_week, end_week_title)
+    # the report is sent, a later merge of the week must not pick these shards up again
+    delete_shards(start_week, run, shard_names)
+    finish_run()
+
+
+if PRELOAD_MODULES:
+    load_report_modules()
+
+_cold_start = True
 
-    upload_file(xlfile, 'aws-ce-reports')
-    send_email_with_attachment(start_week, end_week_title, BODY_HTML, tmp_files, SES_REGION)
\ No newline at end of file
+IMPORT_MILLISECONDS = (time.perf_counter() - _import_started) * 1000
@@ -0,0 +1,111 @@
+"""Tests of the cost cache and the anomaly state kept between weekly reports.
+
+    python -m pytest test_lambda_code_github.py
+"""
+import os
+import tempfile
+import unittest
+
+os.environ.setdefault('ASSUME_ROLE', 'test')
+os.environ.setdefault('SES_REGION', 'us-east-1')
+os.environ.setdefault('SEND_FROM', 'test@example.com')
+
+import lambda_code_github
+
+WEEK_1 = '2024-06-02'
+WEEK_2 = '2024-06-09'
+WEEK_3 = '2024-06-16'
+WEEK_4 = '2024-06-23'
+
+
+def anomaly(anomaly_id, total_impact):
+    return lambda_code_github.Anomaly(
+        'Amazon Elastic Compute Cloud - Compute', '2024-06-02', '2024-06-08', 'us-east-1', 'BoxUsage:m5.large',
+        total_impact, total_impact, [('Amazon Elastic Compute Cloud - Compute', 'us-east-1', 'BoxUsage:m5.large')],
+        anomaly_id=anomaly_id
+    )
+
+
+class CostCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = lambda_code_github.CostCache(os.path.join(self.directory.name, 'cache.sqlite'))
+
+    def tearDown(self):
+        self.cache.conn.close()
+        self.directory.cleanup()
+
+    def test_hits_do_not_mark_the_cache_dirty(self):
+        self.cache.put('key', '123456789011', 'get_cost_and_usage', '2024-06-02', None, {'ResultsByTime': []})
+        self.assertTrue(self.cache.dirty)
+        self.cache.sync()
+        self.assertFalse(self.cache.dirty)
+        self.assertEqual(self.cache.get('key', 'get_cost_and_usage'), {'ResultsByTime': []})
+        self.assertFalse(self.cache.dirty)
+
+    def test_expired_entries_are_misses(self):
+        self.cache.put('key', '123456789011', 'get_anomalies', '2024-06-02', 1.0, {'Anomalies': []})
+        self.assertIsNone(self.cache.get('key', 'get_anomalies'))
+        self.assertEqual(self.cache.stats, {'get_anomalies': {'hits': 0, 'misses': 1}})
+
+
+class AnomalyStateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = lambda_code_github.CostCache(os.path.join(self.directory.name, 'cache.sqlite'))
+        self.state = lambda_code_github.AnomalyState(self.cache)
+
+    def tearDown(self):
+        self.cache.conn.close()
+        self.directory.cleanup()
+
+    def track(self, week, anomalies, complete=True):
+        tracked = self.state.track('123456789011', week, anomalies, complete)
+        return dict((tracked_anomaly.anomaly_id, tracked_anomaly.status) for tracked_anomaly in tracked)
+
+    def test_first_report_is_new(self):
+        self.assertEqual(self.track(WEEK_1, [anomaly('a', 10.0), anomaly('b', 5.0)]), {'a': 'New', 'b': 'New'})
+
+    def test_rerun_in_the_same_week_marks_the_same(self):
+        self.track(WEEK_1, [anomaly('a', 10.0)])
+        self.track(WEEK_2, [anomaly('a', 12.0), anomaly('c', 1.0)])
+        self.assertEqual(self.track(WEEK_2, [anomaly('a', 12.0), anomaly('c', 1.0)]), {'a': 'Grown', 'c': 'New'})
+
+    def test_ongoing_and_grown(self):
+        self.track(WEEK_1, [anomaly('a', 10.0), anomaly('b', 5.0)])
+        self.assertEqual(self.track(WEEK_2, [anomaly('a', 12.0), anomaly('b', 5.0)]), {'a': 'Grown', 'b': 'Ongoing'})
+        self.assertEqual(self.track(WEEK_3, [anomaly('a', 12.0), anomaly('b', 5.0)]), {'a': 'Ongoing', 'b': 'Ongoing'})
+
+    def test_resolved_is_reported_once(self):
+        self.track(WEEK_1, [anomaly('a', 10.0), anomaly('b', 5.0)])
+        self.assertEqual(self.track(WEEK_2, [anomaly('a', 10.0)]), {'a': 'Ongoing', 'b': 'Resolved'})
+        # a rerun of the week shows it again, the next week does not
+        self.assertEqual(self.track(WEEK_2, [anomaly('a', 10.0)]), {'a': 'Ongoing', 'b': 'Resolved'})
+        self.assertEqual(self.track(WEEK_3, [anomaly('a', 10.0)]), {'a': 'Ongoing'})
+
+    def test_failed_query_resolves_nothing(self):
+        self.track(WEEK_1, [anomaly('a', 10.0), anomaly('b', 5.0)])
+        self.assertEqual(self.track(WEEK_2, [], complete=False), {})
+        # the anomalies are compared with the last report that read them
+        self.assertEqual(self.track(WEEK_3, [anomaly('a', 10.0)]), {'a': 'Ongoing', 'b': 'Resolved'})
+        self.assertEqual(self.track(WEEK_4, [anomaly('a', 10.0)]), {'a': 'Ongoing'})
+
+    def test_accounts_are_tracked_apart(self):
+        self.track(WEEK_1, [anomaly('a', 10.0)])
+        self.assertEqual(self.state.track('123456789111', WEEK_2, [anomaly('a', 10.0)])[0].status, 'New')
+        self.assertEqual(self.track(WEEK_2, [anomaly('a', 10.0)]), {'a': 'Ongoing'})
+
+    def test_changes_mode_leaves_ongoing_out(self):
+        self.track(WEEK_1, [anomaly('a', 10.0), anomaly('b', 5.0), anomaly('c', 1.0)])
+        tracking = lambda_code_github.ANOMALY_TRACKING
+        lambda_code_github.ANOMALY_TRACKING = 'changes'
+        try:
+            self.assertEqual(self.track(WEEK_2, [anomaly('a', 12.0), anomaly('b', 5.0), anomaly('d', 3.0)]), {'a': 'Grown', 'd': 'New', 'c': 'Resolved'})
+        finally:
+            lambda_code_github.ANOMALY_TRACKING = tracking
+
+
+if __name__ == '__main__':
+    unittest.main()